@@ -0,0 +1,101 @@
+import datetime
+from collections import defaultdict
+import numpy as np
+import scipy.sparse
+from journalledStore import JournalledStore
+
+HOUR = 3600
+EPOCH_WEEKDAY = 3 # 1970-01-01 was a Thursday
+
+def toEpoch(value):
+    """ epoch seconds from a number, a datetime or an ISO date string (naive means UTC) """
+    if value is None or isinstance(value, (int, float)):
+        return value
+    if isinstance(value, str):
+        value = datetime.datetime.fromisoformat(value)
+    if value.tzinfo is None:
+        value = value.replace(tzinfo=datetime.timezone.utc)
+    return value.timestamp()
+
+class ActivityTable(JournalledStore):
+    """ Messages per user per UTC hour as a sparse users (IdTable rows) x
+        hours-since-epoch matrix. It's built from the time/user columns of the
+        index and then updated from the documents of every commit.
+    """
+    def __init__(self, path, columnStore, compactEvery = 200):
+        self.columnStore = columnStore
+        self.ids = columnStore.ids
+        super().__init__(path, compactEvery)
+
+    def reset(self):
+        self.base = scipy.sparse.csr_matrix((0, 0), dtype=np.int32)
+        self.delta = defaultdict(int) # (row, hour) -> count
+
+    def row(self, uid):
+        return self.ids.intern(uid)
+
+    def apply(self, entry):
+        """ entry["hits"]: [uid, hour, count] """
+        with self.lock:
+            for uid, hour, n in entry["hits"]:
+                self.delta[(self.row(uid), hour)] += n
+
+    def snapshot(self):
+        with self.lock:
+            numUsers = len(self.ids)
+            if self.delta or self.base.shape[0] != numUsers:
+                base = self.base.tocoo()
+                keys = list(self.delta.keys())
+                rows = np.concatenate([base.row, np.array([k[0] for k in keys], dtype=np.int32)])
+                cols = np.concatenate([base.col, np.array([k[1] for k in keys], dtype=np.int64)])
+                data = np.concatenate([base.data, np.array(list(self.delta.values()), dtype=np.int32)])
+                width = int(cols.max()) + 1 if len(cols) else 0
+                self.base = scipy.sparse.csr_matrix((data, (rows, cols)), shape=(numUsers, width), dtype=np.int32)
+                self.delta = defaultdict(int)
+            return self.base
+
+    def arrays(self):
+        matrix = self.snapshot()
+        return dict(data=matrix.data, indices=matrix.indices, indptr=matrix.indptr, shape=np.array(matrix.shape))
+
+    def restore(self, z):
+        self.base = scipy.sparse.csr_matrix((z["data"], z["indices"], z["indptr"]), shape=tuple(z["shape"]))
+        self.delta = defaultdict(int)
+
+    def build(self, reader):
+        cols = self.columnStore.columns(reader)
+        hours = cols.time // HOUR
+        width = int(hours.max()) + 1 if len(hours) else 0
+        self.base = scipy.sparse.csr_matrix((np.ones(len(hours), dtype=np.int32), (cols.user, hours)),
+                                            shape=(len(self.ids), width), dtype=np.int32)
+
+    def update(self, docs):
+        hits = defaultdict(int)
+        for doc in docs:
+            hits[(doc["user"], int(doc["time"].timestamp()) // HOUR)] += 1
+        self.record({"docs": len(docs), "hits": [[u, h, n] for (u, h), n in hits.items()]})
+
+    def histogram(self, uids=None, start=None, end=None):
+        """ 7x24 message counts by UTC weekday (monday first) and hour for
+            the given users (everyone if None), optionally between start and end
+        """
+        matrix = self.snapshot()
+        if uids is None:
+            sub = matrix
+        else:
+            rows = [self.ids.lookup(u) for u in uids]
+            sub = matrix[[r for r in rows if r is not None and r < matrix.shape[0]]]
+        sub = sub.tocoo()
+        hours = sub.col.astype(np.int64)
+        data = sub.data
+        if start is not None or end is not None:
+            keep = np.ones(len(hours), dtype=bool)
+            if start is not None:
+                keep &= hours >= toEpoch(start) // HOUR
+            if end is not None:
+                keep &= hours < toEpoch(end) // HOUR
+            hours = hours[keep]
+            data = data[keep]
+        out = np.zeros((7, 24), dtype=np.int64)
+        np.add.at(out, ((hours // 24 + EPOCH_WEEKDAY) % 7, hours % 24), data)
+        return out.tolist()
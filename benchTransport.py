@@ -0,0 +1,45 @@
+""" Round trip latency of small calls to a running index server over the
+    websocket and over its unix socket. Usage:
+    python benchTransport.py socket [server id] [user id] [port]
+    where socket is the server's "indexSocket"; getCounts is only timed
+    with a user id.
+"""
+import asyncio
+import sys
+import time
+import wsClient
+
+async def bench(call, n = 500):
+    """ median and 99th percentile ms of n sequential calls, after a warm up """
+    for i in range(20):
+        await call()
+    times = []
+    for i in range(n):
+        start = time.perf_counter()
+        await call()
+        times.append(time.perf_counter() - start)
+    times.sort()
+    return times[len(times) // 2] * 1000, times[int(len(times) * 0.99)] * 1000
+
+async def main(socketPath, sid, uid, port):
+    calls = [("ping", "ping", ["", ()]),
+             ("serverStats", sid, ["serverStats", ()])]
+    if uid:
+        calls.append(("getCounts", sid, ["call", ("getCounts", uid)]))
+    print("{0:<12} {1:<10} {2:>10} {3:>10}".format("call", "transport", "median ms", "p99 ms"))
+    for name, path, (method, args) in calls:
+        for transport, unixSocket in (("websocket", None), ("unix", socketPath)):
+            wsClient.unixSocket = unixSocket
+            median, p99 = await bench(lambda: wsClient.call(port, path, method, *args))
+            framed = isinstance(wsClient.connection(port, path).websocket, wsClient.FramedSocket)
+            if framed != (unixSocket is not None):
+                print("{0} over {1} wasn't, is the server listening on {2}?".format(name, transport, socketPath))
+            print("{0:<12} {1:<10} {2:>10.3f} {3:>10.3f}".format(name, transport, median, p99))
+    await wsClient.closeAll()
+
+if __name__ == "__main__":
+    if len(sys.argv) < 2:
+        sys.exit(__doc__)
+    args = sys.argv[1:] + [None] * 3
+    socketPath, sid, uid, port = args[:4]
+    asyncio.get_event_loop().run_until_complete(main(socketPath, sid or "196373421834240000", uid, int(port or 8888)))
@@ -0,0 +1,55 @@
+""" Encode/decode cost and frame size of the RPC wire formats on typical
+    responses. Usage: python benchWire.py [index dir]; with an index dir the
+    responses are real queryStats/userTerms answers, otherwise made up ones
+    of the same shape.
+"""
+import asyncio
+import random
+import sys
+import time
+import wire
+
+def madeUp():
+    random.seed(1)
+    users = [str(200000000000000000 + i) for i in range(400)]
+    words = ["word{0}".format(i) for i in range(5000)]
+    return {"queryStats": [(random.randint(1, 500), u, random.randint(500, 50000)) for u in users],
+            "userTerms": [(random.choice(users), random.choice(words), random.uniform(0, 100)) for i in range(20000)],
+            "answer": [(random.choice(users), " ".join(random.choice(words) for w in range(20))) for i in range(10)]}
+
+def fromIndex(dir):
+    import index
+    from timer import NoTimer
+    ix = index.Index(dir, start = False)
+    stats = ix.queryStats("lol", expand = True)
+    ret = {"queryStats": [r + (ix.getCounts(r[1]),) for r in stats],
+           "userTerms": asyncio.new_event_loop().run_until_complete(ix.terms_async(None, 0.0, minScore = 0)),
+           "answer": ix.query("lol", 10, expand = True, dedupe = True, timer = NoTimer())}
+    ix.close()
+    return ret
+
+def bench(fn, minTime = 0.2):
+    n = 0
+    start = time.perf_counter()
+    while True:
+        fn()
+        n += 1
+        elapsed = time.perf_counter() - start
+        if elapsed > minTime:
+            return elapsed / n
+
+if __name__ == "__main__":
+    responses = fromIndex(sys.argv[1]) if len(sys.argv) > 1 else madeUp()
+    formats = [("json text", None, None), ("json", wire.JSON, None), ("json+zlib", wire.JSON, 0)]
+    if wire.msgpack:
+        formats += [("msgpack", wire.MSGPACK, None), ("msgpack+zlib", wire.MSGPACK, 0)]
+    else:
+        print("msgpack isn't installed, only json is compared")
+    print("{0:<12} {1:<14} {2:>10} {3:>11} {4:>11}".format("response", "format", "bytes", "encode ms", "decode ms"))
+    for name, response in responses.items():
+        message = {"id": 1, "result": response}
+        for label, protocol, compressAbove in formats:
+            frame = wire.encode(protocol, message, compressAbove)
+            encodeTime = bench(lambda: wire.encode(protocol, message, compressAbove))
+            decodeTime = bench(lambda: wire.decode(protocol, frame))
+            print("{0:<12} {1:<14} {2:>10} {3:>11.3f} {4:>11.3f}".format(name, label, len(frame), encodeTime * 1000, decodeTime * 1000))
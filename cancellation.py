@@ -0,0 +1,39 @@
+import time
+
+class Cancelled(Exception):
+    """ raised at a checkpoint of work that nobody is waiting for any more """
+    pass
+
+class CancelToken:
+    """ Handed to long running engine methods, which call check() at
+        checkpoints. It trips when cancel() is called (every caller went
+        away) or once the monotonic deadline passes.
+    """
+    def __init__(self, deadline = None):
+        self.deadline = deadline
+        self.cancelled = False
+
+    def cancel(self):
+        self.cancelled = True
+
+    def extend(self, deadline):
+        """ lets the work run until deadline too; None means no deadline """
+        if self.deadline is not None:
+            self.deadline = None if deadline is None else max(self.deadline, deadline)
+
+    def expired(self):
+        return self.cancelled or (self.deadline is not None and time.monotonic() > self.deadline)
+
+    def check(self):
+        if self.cancelled:
+            raise Cancelled("cancelled")
+        if self.deadline is not None and time.monotonic() > self.deadline:
+            raise Cancelled("deadline passed")
+
+class NoCancel:
+    """ a CancelToken that never trips """
+    def expired(self):
+        return False
+
+    def check(self):
+        pass
@@ -0,0 +1,199 @@
+import os
+import threading
+import numpy as np
+import utils
+import simhash
+
+class Columns:
+    """ Per-document columns for one reader, addressed by global docnum.
+        user: user row (IdTable) of each doc, time: epoch seconds of each doc,
+        mentionDoc/mentionUser: one entry per (doc, mentioned user) pair,
+        simhash: SimHash of each doc's content terms (0 for very short docs),
+        seq: the ContentStore number of each doc, -1 if whoosh stores its fields.
+    """
+    def __init__(self, ids, user, time, mentionDoc, mentionUser, simhash, seq):
+        self.ids = ids
+        self.user = user
+        self.time = time
+        self.mentionDoc = mentionDoc
+        self.mentionUser = mentionUser
+        self.simhash = simhash
+        self.seq = seq
+
+    def row(self, uid):
+        r = self.ids.lookup(uid)
+        return -1 if r is None else r
+
+    def countUsers(self, docs):
+        """ number of docs per user row for an array of docnums """
+        return np.bincount(self.user[docs], minlength=len(self.ids))
+
+class ColumnStore:
+    """ Per-segment user/time/mention/simhash/seq columns kept in <dir>/<segid>.npz.
+        Whoosh segments never change, so a segment's columns are built once
+        from its postings (on first use after a commit or merge) and files
+        for segments that have been merged away are dropped on sync.
+        Users are rows of the shared IdTable.
+    """
+    def __init__(self, dir, ids):
+        self.dir = dir
+        utils.ensureDir(dir)
+        self.ids = ids
+        self.lock = threading.Lock()
+        self.segments = {} # segid -> (user, time, mentionDoc, mentionUser, simhash, seq)
+        self.cache = utils.MRU(32) # segid tuple -> Columns, one per shard plus a combined view
+
+    def row(self, uid):
+        return self.ids.intern(uid)
+
+    def buildSegment(self, segreader):
+        numDocs = segreader.doc_count_all()
+        user = np.zeros(numDocs, dtype=np.int32)
+        for uid in segreader.field_terms("user"):
+            ids = np.fromiter(segreader.postings("user", uid).all_ids(), dtype=np.int64)
+            user[ids] = self.row(uid)
+
+        time = np.zeros(numDocs, dtype=np.int64)
+        timeField = segreader.schema["time"]
+        for btext in timeField.sortable_terms(segreader, "time"):
+            ids = np.fromiter(segreader.postings("time", btext).all_ids(), dtype=np.int64)
+            time[ids] = int(timeField.from_bytes(btext).timestamp())
+
+        mentionDoc, mentionUser = [], []
+        # mentionsUsers is indexed as one comma joined token per document
+        for term in segreader.field_terms("mentionsUsers"):
+            ids = np.fromiter(segreader.postings("mentionsUsers", term).all_ids(), dtype=np.int64)
+            for uid in term.split(","):
+                if uid:
+                    mentionDoc.append(ids)
+                    mentionUser.append(np.full(len(ids), self.row(uid), dtype=np.int32))
+        if mentionDoc:
+            mentionDoc = np.concatenate(mentionDoc)
+            mentionUser = np.concatenate(mentionUser)
+        else:
+            mentionDoc = np.zeros(0, dtype=np.int64)
+            mentionUser = np.zeros(0, dtype=np.int32)
+
+        fingerprints = self.simhashes(segreader, numDocs)
+
+        if "seq" in segreader.schema and segreader.has_column("seq"):
+            seq = np.fromiter(segreader.column_reader("seq"), dtype=np.int64, count=numDocs)
+        else:
+            seq = np.full(numDocs, -1, dtype=np.int64)
+        return user, time, mentionDoc, mentionUser, fingerprints, seq
+
+    def simhashes(self, segreader, numDocs, blockDocs = 1 << 16):
+        """ SimHash of every doc's content terms. The sign sums take BITS
+            int16s a doc, so they're added up blockDocs docs at a time. A
+            bigger segment is first scanned for the docnum range of each
+            term, so that each block only reads the terms that reach into it.
+        """
+        fingerprints = np.zeros(numDocs, dtype=np.uint64)
+        numTerms = np.zeros(numDocs, dtype=np.int32)
+        terms = list(segreader.field_terms("content"))
+        if numDocs > blockDocs:
+            first = np.zeros(len(terms), dtype=np.int64)
+            last = np.zeros(len(terms), dtype=np.int64)
+            for i, term in enumerate(terms):
+                ids = np.fromiter(segreader.postings("content", term).all_ids(), dtype=np.int64)
+                first[i], last[i] = (ids[0], ids[-1]) if len(ids) else (numDocs, -1)
+
+        for lo in range(0, numDocs, blockDocs):
+            hi = min(lo + blockDocs, numDocs)
+            sums = np.zeros((hi - lo, simhash.BITS), dtype=np.int16)
+            inBlock = terms if numDocs <= blockDocs else [terms[i] for i in np.flatnonzero((first < hi) & (last >= lo))]
+            for term in inBlock:
+                postings = segreader.postings("content", term)
+                if numDocs <= blockDocs:
+                    ids = np.fromiter(postings.all_ids(), dtype=np.int64)
+                else:
+                    postings.skip_to(lo)
+                    ids = []
+                    while postings.is_active() and postings.id() < hi:
+                        ids.append(postings.id())
+                        postings.next()
+                    ids = np.array(ids, dtype=np.int64)
+                sums[ids - lo] += simhash.termSigns(term)
+                numTerms[ids] += 1
+            fingerprints[lo:hi] = simhash.fromSums(sums)
+        fingerprints[numTerms < simhash.MIN_TERMS] = 0
+        return fingerprints
+
+    def segment(self, segreader):
+        segid = segreader.segment().segid
+        cols = self.segments.get(segid)
+        if cols:
+            return cols
+
+        path = os.path.join(self.dir, segid + ".npz")
+        try:
+            with np.load(path, allow_pickle=False) as z:
+                cols = (z["user"], z["time"], z["mentionDoc"], z["mentionUser"], z["simhash"], z["seq"])
+        except (IOError, ValueError, KeyError):
+            cols = self.buildSegment(segreader)
+            self.ids.save()
+            tmp = path + ".tmp.npz"
+            np.savez(tmp, user=cols[0], time=cols[1], mentionDoc=cols[2], mentionUser=cols[3], simhash=cols[4], seq=cols[5])
+            os.replace(tmp, path)
+        self.segments[segid] = cols
+        return cols
+
+    def leaves(self, reader):
+        """ the segment readers of reader; an empty index has none """
+        return [(r, offset) for r, offset in reader.leaf_readers() if r.segment() is not None]
+
+    def columns(self, reader):
+        """ Columns for every document visible to reader """
+        leaves = self.leaves(reader)
+        key = tuple(r.segment().segid for r, offset in leaves)
+        with self.lock:
+            cols = self.cache.get(key)
+            if cols:
+                return cols
+            user, time, mentionDoc, mentionUser, fingerprints, seq = [], [], [], [], [], []
+            for segreader, offset in leaves:
+                u, t, md, mu, fp, sq = self.segment(segreader)
+                user.append(u)
+                time.append(t)
+                mentionDoc.append(md + offset)
+                mentionUser.append(mu)
+                fingerprints.append(fp)
+                seq.append(sq)
+            empty = lambda dtype: np.zeros(0, dtype=dtype)
+            cols = Columns(self.ids,
+                           np.concatenate(user) if user else empty(np.int32),
+                           np.concatenate(time) if time else empty(np.int64),
+                           np.concatenate(mentionDoc) if mentionDoc else empty(np.int64),
+                           np.concatenate(mentionUser) if mentionUser else empty(np.int32),
+                           np.concatenate(fingerprints) if fingerprints else empty(np.uint64),
+                           np.concatenate(seq) if seq else empty(np.int64))
+            self.cache.insert(key, cols)
+            return cols
+
+    def memoryUsage(self):
+        """ rough bytes of the segment columns and combined views held in memory """
+        with self.lock:
+            arrays = [a for cols in self.segments.values() for a in cols]
+            arrays += [getattr(cols, name) for cols in self.cache.map.values()
+                       for name in ("user", "time", "mentionDoc", "mentionUser", "simhash", "seq")]
+        return sum(a.nbytes for a in arrays)
+
+    def sync(self, reader, parts = None):
+        """ Builds columns for new segments and drops files of merged ones.
+            parts are the segid tuples of each shard of reader; only the
+            views of those and of the whole reader are kept.
+        """
+        self.columns(reader)
+        live = set(r.segment().segid for r, offset in self.leaves(reader))
+        keep = set(parts or ()) | {tuple(r.segment().segid for r, offset in self.leaves(reader))}
+        with self.lock:
+            for key in list(self.cache.map):
+                if key not in keep:
+                    del self.cache.map[key]
+            for segid in list(self.segments):
+                if segid not in live:
+                    del self.segments[segid]
+            for file in os.listdir(self.dir):
+                name, ext = os.path.splitext(file)
+                if ext == ".npz" and name not in live:
+                    os.remove(os.path.join(self.dir, file))
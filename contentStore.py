@@ -0,0 +1,118 @@
+import bisect
+import json
+import mmap
+import os
+import threading
+import zlib
+import numpy as np
+import utils
+
+FIELDS = ("user", "content", "mentionsUsers", "mentionsRoles")
+
+class ContentStore:
+    """ The stored fields of every document, kept beside the index instead
+        of in whoosh's stored fields and addressed by the seq number append()
+        hands out. Documents are written in zlib compressed blocks of up to
+        blockDocs to <dir>/blocks, one json record per line, which is read
+        through mmap and decoded a record at a time; <dir>/blocks.idx
+        holds (offset, length, firstSeq, count) per block. Both files are
+        append only; anything past the last indexed block (a crash mid
+        append) is cut off on open.
+    """
+    def __init__(self, dir, blockDocs = 32, cacheBlocks = 4096):
+        self.dir = dir
+        utils.ensureDir(dir)
+        self.blockDocs = blockDocs
+        self.dataPath = os.path.join(dir, "blocks")
+        self.indexPath = os.path.join(dir, "blocks.idx")
+        self.lock = threading.Lock()
+        self.cache = utils.MRU(cacheBlocks) # block -> decompressed record lines
+        self.map = None
+
+        entries = np.zeros(0, dtype=np.int64)
+        if os.path.exists(self.indexPath):
+            entries = np.fromfile(self.indexPath, dtype="<i8")
+        entries = entries[:len(entries) // 4 * 4].reshape(-1, 4)
+        end = int(entries[-1, 0] + entries[-1, 1]) if len(entries) else 0
+        if not os.path.exists(self.dataPath) or os.path.getsize(self.dataPath) < end:
+            # blocks went missing, only trust what's on disk
+            size = os.path.getsize(self.dataPath) if os.path.exists(self.dataPath) else 0
+            entries = entries[entries[:, 0] + entries[:, 1] <= size]
+            end = int(entries[-1, 0] + entries[-1, 1]) if len(entries) else 0
+        with open(self.dataPath, "ab") as f:
+            f.truncate(end)
+        with open(self.indexPath, "ab") as f:
+            f.truncate(entries.size * 8)
+        self.offsets = entries[:, 0].tolist()
+        self.lengths = entries[:, 1].tolist()
+        self.firstSeqs = entries[:, 2].tolist()
+        self.nextSeq = int(entries[-1, 2] + entries[-1, 3]) if len(entries) else 0
+        self.size = end
+
+    def __len__(self):
+        return self.nextSeq
+
+    def append(self, docs):
+        """ stores docs and returns the seq of the first one, the rest follow on """
+        with self.lock:
+            first = self.nextSeq
+            entries = []
+            with open(self.dataPath, "ab") as data:
+                for i in range(0, len(docs), self.blockDocs):
+                    chunk = docs[i:i + self.blockDocs]
+                    lines = "\n".join(json.dumps([doc[f] for f in FIELDS]) for doc in chunk)
+                    payload = zlib.compress(lines.encode("utf-8"))
+                    data.write(payload)
+                    entries.append((self.size, len(payload), self.nextSeq, len(chunk)))
+                    self.size += len(payload)
+                    self.nextSeq += len(chunk)
+            with open(self.indexPath, "ab") as index:
+                index.write(np.array(entries, dtype="<i8").tobytes())
+            for offset, length, firstSeq, count in entries:
+                self.offsets.append(offset)
+                self.lengths.append(length)
+                self.firstSeqs.append(firstSeq)
+            self.map = None
+            return first
+
+    def mapped(self):
+        m = self.map
+        if m is None or len(m) < self.size:
+            with open(self.dataPath, "rb") as f:
+                m = self.map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        return m
+
+    def block(self, b):
+        with self.lock:
+            records = self.cache.get(b)
+            if records is not None:
+                return records
+            offset, length = self.offsets[b], self.lengths[b]
+            payload = self.mapped()[offset:offset + length]
+        records = zlib.decompress(payload).split(b"\n")
+        with self.lock:
+            self.cache.insert(b, records)
+        return records
+
+    def get(self, seq):
+        """ the stored fields of document seq """
+        b = bisect.bisect_right(self.firstSeqs, seq) - 1
+        if b < 0 or seq >= self.nextSeq:
+            raise KeyError(seq)
+        return dict(zip(FIELDS, json.loads(self.block(b)[seq - self.firstSeqs[b]])))
+
+    def memoryUsage(self):
+        """ rough bytes of the decompressed blocks in the cache """
+        with self.lock:
+            blocks = list(self.cache.map.values())
+        return sum(len(record) for records in blocks for record in records)
+
+    def close(self):
+        with self.lock:
+            self.cache = utils.MRU(self.cache.size)
+            if self.map is not None:
+                self.map.close()
+                self.map = None
+
+    def stats(self):
+        return {"docs": self.nextSeq, "blocks": len(self.offsets), "bytes": self.size}
@@ -0,0 +1,74 @@
+import json
+import os
+import numpy as np
+
+class CountTable:
+    """ Number of indexed messages per user, as an array indexed by IdTable row.
+        indexLoop updates it at commit time and it's persisted next to the
+        index, tagged with the document count it matches. A table that
+        doesn't match the index is rebuilt from the user field's postings.
+    """
+    def __init__(self, path, ids):
+        self.path = path
+        self.ids = ids
+        self.counts = np.zeros(0, dtype=np.int64)
+        self.docCount = -1
+
+    def get(self, uid):
+        r = self.ids.lookup(uid)
+        return int(self.counts[r]) if r is not None and r < len(self.counts) else 0
+
+    def byRow(self, rows):
+        """ counts of an array of rows """
+        counts = self.counts
+        rows = np.asarray(rows, dtype=np.int64)
+        out = np.zeros(len(rows), dtype=np.int64)
+        inside = rows < len(counts)
+        out[inside] = counts[rows[inside]]
+        return out
+
+    def grow(self):
+        if len(self.counts) < len(self.ids):
+            self.counts = np.concatenate([self.counts, np.zeros(len(self.ids) - len(self.counts), dtype=np.int64)])
+
+    def load(self):
+        try:
+            with open(self.path, "r", encoding="utf-8") as f:
+                j = json.loads(f.read())
+            self.counts = np.array(j["counts"], dtype=np.int64)
+            self.docCount = j["docCount"]
+            self.grow()
+            return True
+        except (IOError, ValueError, KeyError):
+            return False
+
+    def save(self):
+        tmp = self.path + ".tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            f.write(json.dumps({"docCount": self.docCount, "counts": self.counts.tolist()}))
+        os.replace(tmp, self.path)
+
+    def build(self, reader):
+        rows, n = [], []
+        for uid in reader.field_terms("user"):
+            rows.append(self.ids.intern(uid))
+            n.append(reader.doc_frequency("user", uid))
+        counts = np.zeros(len(self.ids), dtype=np.int64)
+        counts[np.array(rows, dtype=np.int64)] = n
+        self.counts = counts
+        self.docCount = reader.doc_count_all()
+
+    def memoryUsage(self):
+        return self.counts.nbytes
+
+    def sync(self, reader):
+        """ loads the saved table, rebuilding it if it's missing or stale """
+        if not self.load() or self.docCount != reader.doc_count_all():
+            self.build(reader)
+            self.save()
+
+    def update(self, docs):
+        rows = [self.ids.intern(doc["user"]) for doc in docs]
+        self.grow()
+        np.add.at(self.counts, np.array(rows, dtype=np.int64), 1)
+        self.docCount += len(docs)
@@ -0,0 +1,153 @@
+import threading
+import time
+import uuid
+
+class Cursor:
+    """ A query read page by page from a searcher snapshot that stays pinned
+        until the cursor is closed, so later pages never shift under a commit.
+        Hits are scored window docs at a time; running past the window
+        re-runs the search on the same snapshot with a doubled one.
+    """
+    def __init__(self, scoped, query, dedupe = True, window = 64, nearDups = None, columnStore = None, fieldReader = None):
+        self.scoped = scoped
+        self.searcher = scoped.__enter__()
+        self.query = query
+        self.seen = set() if dedupe else None
+        # near duplicates are dropped by the simhash column of the snapshot
+        self.nearDups = nearDups
+        self.fingerprints = columnStore.columns(self.searcher.reader()).simhash if nearDups else None
+        # docnum -> stored fields, whoosh's own by default
+        self.fields = fieldReader(self.searcher.reader()) if fieldReader else self.searcher.stored_fields
+        self.window = window
+        self.results = None
+        self.position = 0
+        self.done = False
+        self.lastUsed = time.time()
+        self.lock = threading.Lock()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, a, b, c):
+        self.close()
+
+    def next(self):
+        """ the next (user, content), or None at the end """
+        while not self.done:
+            if self.results is None or (self.position >= self.results.scored_length() >= self.window):
+                if self.results is not None:
+                    self.window *= 2
+                self.results = self.searcher.search(self.query, limit = self.window)
+            if self.position >= self.results.scored_length():
+                self.done = True
+                break
+            hit = self.results[self.position]
+            fields = self.fields(hit.docnum)
+            self.position += 1
+            if self.seen is not None:
+                if fields["content"] in self.seen:
+                    continue
+                self.seen.add(fields["content"])
+            if self.nearDups and self.nearDups.seen(int(self.fingerprints[hit.docnum])):
+                continue
+            return (fields["user"], fields["content"])
+        return None
+
+    def fetch(self, count):
+        """ up to count rows; fewer only at the end """
+        with self.lock:
+            self.lastUsed = time.time()
+            rows = []
+            while len(rows) < count:
+                row = self.next()
+                if row is None:
+                    break
+                rows.append(row)
+            return rows
+
+    def rows(self, pageSize = 50, max = None):
+        """ every row, fetched pageSize at a time """
+        served = 0
+        while max is None or served < max:
+            page = self.fetch(pageSize if max is None else min(pageSize, max - served))
+            for row in page:
+                yield row
+            served += len(page)
+            if self.done:
+                break
+
+    def close(self):
+        with self.lock:
+            if self.scoped:
+                self.done = True
+                self.results = None
+                self.scoped.__exit__(None, None, None)
+                self.scoped = None
+
+class CursorTable:
+    """ Open cursors by id. Cursors nobody fetched from for idleTimeout
+        seconds are closed by a sweeper thread, and so are the oldest ones
+        when more than maxCursors are open.
+    """
+    def __init__(self, idleTimeout = 60, maxCursors = 64):
+        self.idleTimeout = idleTimeout
+        self.maxCursors = maxCursors
+        self.cursors = {}
+        self.lock = threading.Lock()
+        self.stopping = threading.Event()
+        self.sweeper = threading.Thread(target = CursorTable.sweepLoop, args = [self], daemon = True)
+        self.sweeper.start()
+
+    def add(self, cursor):
+        id = uuid.uuid4().hex
+        with self.lock:
+            self.cursors[id] = cursor
+            evicted = []
+            while len(self.cursors) > self.maxCursors:
+                oldest = min(self.cursors, key = lambda k: self.cursors[k].lastUsed)
+                evicted.append(self.cursors.pop(oldest))
+        for c in evicted:
+            c.close()
+        return id
+
+    def fetch(self, id, count):
+        """ {"cursor", "rows", "done"}; a finished cursor is closed straight away """
+        with self.lock:
+            cursor = self.cursors.get(id)
+        if cursor is None:
+            raise KeyError("unknown or expired cursor {0}".format(id))
+        rows = cursor.fetch(count)
+        if cursor.done:
+            self.close(id)
+        return {"cursor": id, "rows": rows, "done": cursor.done}
+
+    def close(self, id):
+        with self.lock:
+            cursor = self.cursors.pop(id, None)
+        if cursor:
+            cursor.close()
+        return cursor is not None
+
+    def sweep(self):
+        cutoff = time.time() - self.idleTimeout
+        with self.lock:
+            idle = [id for id, c in self.cursors.items() if c.lastUsed < cutoff]
+        for id in idle:
+            self.close(id)
+        return len(idle)
+
+    def sweepLoop(self):
+        while not self.stopping.wait(max(self.idleTimeout / 4, 1)):
+            self.sweep()
+
+    def closeAll(self):
+        """ closes every cursor and stops the sweeper """
+        self.stopping.set()
+        with self.lock:
+            ids = list(self.cursors)
+        for id in ids:
+            self.close(id)
+
+    def stats(self):
+        with self.lock:
+            return {"open": len(self.cursors)}
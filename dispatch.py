@@ -0,0 +1,147 @@
+import asyncio
+import functools
+import inspect
+import json
+import time
+import cancellation
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+
+class Flight:
+    """ a computation in flight, its cancel token and how many callers wait on it """
+    def __init__(self, task, token):
+        self.task = task
+        self.token = token
+        self.waiters = 0
+        # nobody may be left to see how it ended
+        task.add_done_callback(lambda t: t.cancelled() or t.exception())
+
+class Dispatcher:
+    """ Runs blocking RPC methods on a thread pool so the event loop stays
+        free for /ping, cheap calls and the websocket traffic itself.
+
+        Every method name gets its own semaphore, limits[name] or else
+        defaultLimit (half the threads), so one slow kind of call can never
+        take every thread. Calls over their limit wait on the loop and are
+        reported as queued. Coroutine methods are awaited on the loop under
+        the same limits. shared() lets identical calls that overlap in time
+        wait on one computation and cancels work nobody waits for any more.
+        Counters are only touched from the loop.
+    """
+    def __init__(self, threads = 8, limits = {}, defaultLimit = None):
+        self.threads = threads
+        self.pool = ThreadPoolExecutor(threads, thread_name_prefix = "rpc")
+        self.limits = dict(limits)
+        self.defaultLimit = defaultLimit or max(1, threads // 2)
+        self.semaphores = {}
+        self.queued = defaultdict(int)
+        self.running = defaultdict(int)
+        self.done = defaultdict(int)
+        self.peakQueued = defaultdict(int)
+        self.inflight = {}                 # callKey -> Flight of the shared computation
+        self.coalesced = defaultdict(int)  # method name -> calls that joined one in flight
+        self.cancelled = defaultdict(int)  # method name -> calls given up on before they finished
+
+    def limit(self, name):
+        return int(self.limits.get(name, self.defaultLimit))
+
+    def semaphore(self, name):
+        semaphore = self.semaphores.get(name)
+        if semaphore is None:
+            semaphore = self.semaphores[name] = asyncio.Semaphore(self.limit(name))
+        return semaphore
+
+    async def offload(self, fn, *args, **kwargs):
+        """ fn(*args, **kwargs) on the pool, outside any method limit """
+        return await asyncio.get_event_loop().run_in_executor(self.pool, functools.partial(fn, *args, **kwargs))
+
+    async def run(self, name, fn, *args, cancel = None, **kwargs):
+        """ fn(*args, **kwargs) on the pool, or awaited if it's a coroutine
+            function, at most limit(name) at a time. fn gets the cancel token
+            if it takes one; a call cancelled while queued never starts.
+        """
+        semaphore = self.semaphore(name)
+        self.queued[name] += 1
+        self.peakQueued[name] = max(self.peakQueued[name], self.queued[name])
+        try:
+            await semaphore.acquire()
+        finally:
+            self.queued[name] -= 1
+        try:
+            if cancel is not None:
+                cancel.check()
+                if "cancel" in inspect.signature(fn).parameters:
+                    kwargs["cancel"] = cancel
+            self.running[name] += 1
+            try:
+                if inspect.iscoroutinefunction(fn):
+                    return await fn(*args, **kwargs)
+                return await self.offload(fn, *args, **kwargs)
+            finally:
+                self.running[name] -= 1
+                self.done[name] += 1
+        except cancellation.Cancelled:
+            self.cancelled[name] += 1
+            raise
+        finally:
+            semaphore.release()
+
+    async def shared(self, key, name, fn, *args, deadline = None, **kwargs):
+        """ run(name, fn, ...) unless a call with the same key is in flight,
+            in which case this one waits for that one's result; a None key is
+            never shared. The work is cancelled once every caller has gone
+            or its deadline (time.monotonic()) has passed, so waiting stops
+            at the deadline too.
+        """
+        flight = self.inflight.get(key) if key is not None else None
+        if flight is None:
+            token = cancellation.CancelToken(deadline)
+            flight = Flight(asyncio.ensure_future(self.run(name, fn, *args, cancel = token, **kwargs)), token)
+            if key is not None:
+                self.inflight[key] = flight
+                def forget(done):
+                    if self.inflight.get(key) is flight:
+                        del self.inflight[key]
+                flight.task.add_done_callback(forget)
+        else:
+            self.coalesced[name] += 1
+            flight.token.extend(deadline)
+        flight.waiters += 1
+        try:
+            # a caller that goes away doesn't cancel the others' computation
+            if deadline is None:
+                return await asyncio.shield(flight.task)
+            try:
+                return await asyncio.wait_for(asyncio.shield(flight.task), max(deadline - time.monotonic(), 0))
+            except asyncio.TimeoutError:
+                raise cancellation.Cancelled("deadline passed")
+        finally:
+            flight.waiters -= 1
+            if not flight.waiters and not flight.task.done():
+                flight.token.cancel()
+
+    def stats(self):
+        names = sorted(set(self.queued) | set(self.running) | set(self.done))
+        return {"threads": self.threads,
+                "queued": sum(self.queued.values()),
+                "running": sum(self.running.values()),
+                "inflight": len(self.inflight),
+                "methods": {name: {"limit": self.limit(name),
+                                   "queued": self.queued[name],
+                                   "peakQueued": self.peakQueued[name],
+                                   "running": self.running[name],
+                                   "done": self.done[name],
+                                   "coalesced": self.coalesced[name],
+                                   "cancelled": self.cancelled[name]} for name in names}}
+
+def callKey(sid, name, fn, args, kwargs):
+    """ the same key for every call of fn with the same arguments, however
+        they were passed (positionally, by keyword or left to their defaults)
+    """
+    try:
+        bound = inspect.signature(fn).bind(*args, **kwargs)
+        bound.apply_defaults()
+        arguments = sorted(bound.arguments.items())
+    except (TypeError, ValueError):
+        arguments = [args, sorted(kwargs.items())]
+    return json.dumps([sid, name, arguments], sort_keys = True, default = repr)
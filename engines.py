@@ -0,0 +1,149 @@
+import threading
+import time
+import traceback
+from collections import OrderedDict, defaultdict
+from concurrent.futures import ThreadPoolExecutor
+
+class EngineTable:
+    """ The TextEngine of every server, opened by make(key) on first use.
+
+        Engines are kept in least recently used order. While together they
+        are estimated to use more than memoryBudget bytes, a sweeper thread
+        closes the least recently used idle ones: no call running on them,
+        no open cursors, unused for idleSeconds and not running the indexer
+        (that's the server's only ingest). A closed engine is simply opened
+        again by the next call for it.
+    """
+    def __init__(self, make, memoryBudget = None, idleSeconds = 300, sweepInterval = 30):
+        self.make = make
+        self.memoryBudget = memoryBudget
+        self.idleSeconds = idleSeconds
+        self.lock = threading.Lock()
+        self.engines = OrderedDict()            # key -> engine, least recently used first
+        self.lastUsed = {}
+        self.busy = defaultdict(int)            # key -> calls running on its engine
+        self.opening = defaultdict(threading.Lock) # key -> held while its engine is made
+        self.opened = 0
+        self.evicted = 0
+        self.stopping = threading.Event()
+        self.sweeper = threading.Thread(target = EngineTable.sweepLoop, args = [self, sweepInterval], daemon = True)
+        self.sweeper.start()
+
+    def touch(self, key):
+        self.engines.move_to_end(key)
+        self.lastUsed[key] = time.time()
+
+    def acquire(self, key, open = True):
+        """ the engine of key, opened if need be or else None when open is
+            False; it can't be evicted until release(key)
+        """
+        with self.lock:
+            engine = self.engines.get(key)
+            if engine is not None:
+                self.busy[key] += 1
+                self.touch(key)
+                return engine
+            if not open:
+                return None
+            opening = self.opening[key]
+        with opening:
+            with self.lock:
+                engine = self.engines.get(key)
+            if engine is None:
+                engine = self.make(key)
+                with self.lock:
+                    self.engines[key] = engine
+                    self.opened += 1
+            with self.lock:
+                self.busy[key] += 1
+                self.touch(key)
+        return engine
+
+    def release(self, key):
+        with self.lock:
+            self.busy[key] -= 1
+            if not self.busy[key]:
+                del self.busy[key]
+            if key in self.engines:
+                self.touch(key)
+
+    def __getitem__(self, key):
+        engine = self.acquire(key)
+        self.release(key)
+        return engine
+
+    def get(self, key):
+        """ the engine of key if it's open, without opening it """
+        with self.lock:
+            return self.engines.get(key)
+
+    def prewarm(self, keys, canaries = (), threads = 4):
+        """ opens and warms the engines of keys in parallel """
+        def warm(key):
+            start = time.time()
+            try:
+                engine = self.acquire(key)
+            except Exception:
+                print("prewarm of {0} failed: {1}".format(key, traceback.format_exc()))
+                return
+            try:
+                engine.prewarm(canaries)
+                print("prewarmed {0} in {1:.2f}s".format(key, time.time() - start))
+            except Exception:
+                print("prewarm of {0} failed: {1}".format(key, traceback.format_exc()))
+            finally:
+                self.release(key)
+        with ThreadPoolExecutor(max(1, threads)) as pool:
+            list(pool.map(warm, keys))
+
+    def evictable(self, key, engine, cutoff):
+        return (not self.busy.get(key) and self.lastUsed.get(key, 0) < cutoff
+                and not engine.openCursorCount() and not engine.start)
+
+    def sweep(self):
+        """ closes least recently used idle engines until the rest fit memoryBudget; returns how many """
+        if not self.memoryBudget:
+            return 0
+        with self.lock:
+            engines = list(self.engines.items())
+        usage = {key: engine.memoryUsage() for key, engine in engines}
+        total = sum(usage.values())
+        cutoff = time.time() - self.idleSeconds
+        closed = 0
+        for key, engine in engines:
+            if total <= self.memoryBudget:
+                break
+            with self.lock:
+                if self.engines.get(key) is not engine or not self.evictable(key, engine, cutoff):
+                    continue
+                del self.engines[key]
+                self.lastUsed.pop(key, None)
+                self.evicted += 1
+            engine.close()
+            total -= usage[key]
+            closed += 1
+        return closed
+
+    def sweepLoop(self, interval):
+        while not self.stopping.wait(interval):
+            try:
+                self.sweep()
+            except Exception:
+                print("engine sweep failed: {0}".format(traceback.format_exc()))
+
+    def close(self):
+        """ stops the sweeper and closes every engine """
+        self.stopping.set()
+        with self.lock:
+            engines = list(self.engines.values())
+            self.engines = OrderedDict()
+        for engine in engines:
+            engine.close()
+
+    def stats(self):
+        with self.lock:
+            return {"open": list(self.engines),
+                    "busy": dict(self.busy),
+                    "opened": self.opened,
+                    "evicted": self.evicted,
+                    "memoryBudget": self.memoryBudget}
@@ -0,0 +1,81 @@
+import os
+import threading
+
+class IdTable:
+    """ Dense int ids for the user ids (Discord snowflakes) of one server,
+        shared by the columns and every side table so they all address users
+        by the same row. Ids are handed out in order of first sight and never
+        change; the table is persisted append-only to path, one user id per
+        line, so row n is line n. Strings only appear again at the RPC edge.
+    """
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.userIds = []
+        self.rows = {}
+        try:
+            with open(path, "r", encoding="utf-8") as f:
+                for line in f:
+                    uid = line.rstrip("\n")
+                    if uid:
+                        self.rows[uid] = len(self.userIds)
+                        self.userIds.append(uid)
+        except IOError:
+            pass
+        self.saved = len(self.userIds)
+
+    def __len__(self):
+        return len(self.userIds)
+
+    def intern(self, uid):
+        """ the row of uid, assigning the next one if it's new """
+        r = self.rows.get(uid)
+        if r is None:
+            with self.lock:
+                r = self.rows.get(uid)
+                if r is None:
+                    r = len(self.userIds)
+                    self.userIds.append(uid)
+                    self.rows[uid] = r
+        return r
+
+    def lookup(self, uid):
+        """ the row of uid, None if it has never been seen """
+        return self.rows.get(uid)
+
+    def uid(self, row):
+        return self[row]
+
+    def __getitem__(self, row):
+        if row >= len(self.userIds):
+            self.catchUp()
+        return self.userIds[row]
+
+    def catchUp(self):
+        """ reads the rows another process (the indexer) appended to path
+            since, which only line up while this one has none unsaved
+        """
+        with self.lock:
+            if self.saved != len(self.userIds):
+                return
+            try:
+                with open(self.path, "r", encoding="utf-8") as f:
+                    lines = f.read().split("\n")
+            except IOError:
+                return
+            for uid in lines[len(self.userIds):]:
+                if uid:
+                    self.rows[uid] = len(self.userIds)
+                    self.userIds.append(uid)
+            self.saved = len(self.userIds)
+
+    def save(self):
+        with self.lock:
+            new = self.userIds[self.saved:]
+            if not new:
+                return
+            with open(self.path, "a", encoding="utf-8") as f:
+                f.write("".join(uid + "\n" for uid in new))
+                f.flush()
+                os.fsync(f.fileno())
+            self.saved += len(new)
@@ -1,27 +1,51 @@
 import whoosh
-import math
-from whoosh.fields import Schema, TEXT, ID ,KEYWORD, DATETIME, NUMERIC
+from whoosh.fields import Schema, TEXT, ID ,KEYWORD, DATETIME, NUMERIC, COLUMN
+import whoosh.columns
 import shutil
 import os.path
-from whoosh.index import create_in
 import json
 import re
 import whoosh.scoring
 from timer import Timer, NoTimer
+from cancellation import NoCancel
 from whoosh.qparser import QueryParser
 from collections import defaultdict
 import threading
+import asyncio
 import datetime
 import time
 import utils
+import ids
+import counts
+import termMatrix
+import columns
+import activity
+import mentionGraph
+import shards
+import merges
+import cursors
+import simhash
+import contentStore
+import whoosh.writing
+import whoosh.searching
+from activity import toEpoch
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
 from whoosh.util.text import rcompile
+try:
+    import inotify_simple
+except ImportError:
+    inotify_simple = None
 
 class Results:
-    def __init__(self, gen, dedupe=True):
+    def __init__(self, gen, dedupe=True, nearDups=None, fingerprint=None):
         self.dedupe = dedupe
         self.gen = gen
         self.seen = set([])
         self.field = "content"
+        # a simhash.NearDupFilter and a text -> fingerprint function
+        self.nearDups = nearDups
+        self.fingerprint = fingerprint
 
     def __iter__(self):
         return self
@@ -33,23 +57,84 @@ class Results:
                 continue
             if self.dedupe:
                 self.seen.add(candidate[self.field])
+            if self.nearDups and self.nearDups.seen(self.fingerprint(candidate[self.field])):
+                continue
             return (candidate["user"], candidate[self.field])
 
-def deduper(it, dedupe=True, field="content"):
+def deduper(it, dedupe=True, field="content", nearDups=None):
+    """ (user, content) of stored fields, dropping repeated contents if dedupe
+        and near duplicates (by their "simhash" field) if given a NearDupFilter
+    """
     seen = set([])
     for item in it:
         if dedupe and item[field] in seen:
                 continue
         if dedupe:
             seen.add(item[field])
+        if nearDups and nearDups.seen(item.get("simhash", 0)):
+            continue
         yield (item["user"], item[field])
     return None
 
+def mergeHits(parts, limit):
+    """ merges per-shard [(score, fields)] lists into the best limit fields """
+    hits = [hit for part in parts for hit in part]
+    if len(parts) > 1:
+        hits = sorted(hits, key=lambda hit: -hit[0])
+    return [fields for score, fields in hits[:limit]]
+
 tok_pat = rcompile(r"[+£€]?\w+(\.?\w+)*")
 STOP_WORDS = frozenset(('a', 'an', 'and', 'are', 'as', 'at', 'be', 'by', 'can',
                         'for', 'from', 'have', 'if', 'in', 'is', 'it', 'may',
                         'not', 'of', 'on', 'or', 'tbd', 'that', 'the', 'this',
                         'to', 'when', 'will', 'with', 'yet'))
+# side tables in baseDir that mirror the index and are only checked
+# against it by document count; a rebuilt index needs them dropped
+SIDE_TABLES = ("counts.json", "terms.npz", "activity.npz", "mentions.npz")
+
+def toDocument(doc):
+    """ Maps one chatLogger json line onto the fields of Index.schema """
+    return dict(content=doc["content"].strip(),
+                user="{0}".format(doc["user"]),
+                mentionsUsers=",".join(doc["mentions"]),
+                mentionsRoles=",".join(doc["role_mentions"]),
+                time=datetime.datetime.fromtimestamp(doc["timestamp"]))
+
+class PartialCommit(Exception):
+    """ a group commit that failed after the documents of some of its files were committed """
+    def __init__(self, committed, cause):
+        super().__init__("{0} (after {1} files were committed)".format(cause, len(committed)))
+        self.committed = committed # paths whose documents are in the index, at least in part
+
+class IncomingWatcher:
+    """ Blocks until something lands in a directory. Uses inotify where it's
+        available and falls back to polling otherwise.
+    """
+    def __init__(self, dir, pollInterval = 1.0):
+        self.dir = dir
+        self.pollInterval = pollInterval
+        self.inotify = None
+        if inotify_simple:
+            try:
+                self.inotify = inotify_simple.INotify()
+                flags = inotify_simple.flags
+                self.inotify.add_watch(dir, flags.MOVED_TO | flags.CLOSE_WRITE)
+            except OSError:
+                self.inotify = None
+
+    def wait(self, timeout):
+        """ returns when a file may have arrived, or after timeout seconds """
+        timeout = max(timeout, 0)
+        if self.inotify:
+            self.inotify.read(timeout = int(timeout * 1000))
+        else:
+            time.sleep(min(timeout, self.pollInterval))
+
+    def close(self):
+        if self.inotify:
+            self.inotify.close()
+            self.inotify = None
+
 def Analyzer(expression=tok_pat, stoplist=None, minsize=1, maxsize=None, gaps=False):
     if stoplist is None:
         stoplist = STOP_WORDS
@@ -59,197 +144,554 @@ def Analyzer(expression=tok_pat, stoplist=None, minsize=1, maxsize=None, gaps=Fa
                                             maxsize=maxsize, 
                                             gaps=gaps)
 class Index:
-    schema = Schema(content=TEXT(stored=True, analyzer=Analyzer()), 
-                    user=ID(stored=True),
-                    mentionsUsers=KEYWORD(stored=True),
-                    mentionsRoles=KEYWORD(stored=True),
-                    time=DATETIME)
-
-    def __init__(self, dir, authorIds = {}, context = None, start=True, baseDir=None):
-        if not os.path.isdir(dir):
-            os.mkdir(dir)
-
-        if not list(os.listdir(dir)):
-            self.ix = create_in(dir, Index.schema)
-
+    # stored fields live in the ContentStore under seq; indexes from before
+    # that keep them in whoosh and get seq added for new documents
+    schema = Schema(content=TEXT(analyzer=Analyzer()), 
+                    user=ID,
+                    mentionsUsers=KEYWORD,
+                    mentionsRoles=KEYWORD,
+                    time=DATETIME,
+                    seq=COLUMN(whoosh.columns.NumericColumn("q", default=-1)))
+
+    def __init__(self, dir, authorIds = {}, context = None, start=True, baseDir=None, commitDocs=20000, commitLatency=1.0,
+                 cacheEntries=1024, cacheBytes=32*1024*1024, shardBy=None, searchThreads=4,
+                 mergePolicy=None, offPeakHours=None, mergeQuiet=30, nearDupDistance=3, collapseNearDups=False):
         if not baseDir:
             baseDir = os.path.join(os.path.split(dir)[0])
 
-        self.ix = whoosh.index.open_dir(dir)
-        self.searchers = []
+        self.dir = dir
+        self.shardBy = shardBy
+        self.shards = shards.openShards(dir, Index.schema, shardBy)
+        if not self.shards:
+            period = shards.periodOf(datetime.datetime.now(), shardBy)
+            self.shards.append(shards.Shard(period, os.path.join(dir, period), Index.schema))
+        # the newest shard takes every write
+        self.ix = self.shards[-1].ix
+        self.pool = ThreadPoolExecutor(searchThreads)
+        # query results keyed by generation, cleared on every commit
+        self.cache = utils.LRUCache(cacheEntries, cacheBytes)
         self.failedDir = os.path.join(baseDir, "failed")
         utils.ensureDir(self.failedDir)
         self.incomingDir = os.path.join(baseDir, "incoming")
         utils.ensureDir(self.incomingDir)
         self.indexer = threading.Thread(target = Index.indexLoop, args=[self])
         self.logger = open(os.path.join(baseDir,"index.log"), "a")
+        self.commitDocs = commitDocs
+        self.commitLatency = commitLatency
+        # held by anything that writes to a shard: ingest commits, seals and merges
+        self.writeLock = threading.Lock()
+        self.lastCommit = 0
+        self.merger = merges.MergeScheduler(self, mergePolicy, offPeakHours, mergeQuiet)
+        # deduped results also drop contents within nearDupDistance bits (SimHash), 0 turns that off
+        self.nearDupDistance = nearDupDistance
+        self.collapseNearDups = collapseNearDups
+
+        # stored fields of every document indexed with a seq
+        self.content = contentStore.ContentStore(os.path.join(baseDir, "content"))
+        # dense int ids for user ids, shared by the columns and the side tables
+        self.ids = ids.IdTable(os.path.join(baseDir, "ids.txt"))
+        # per-segment docnum columns, picked up after every commit
+        self.columns = columns.ColumnStore(os.path.join(baseDir, "columns"), self.ids)
+        # side tables that indexLoop keeps in step with every commit
+        self.counts = counts.CountTable(os.path.join(baseDir, "counts.json"), self.ids)
+        self.termMatrix = termMatrix.TermMatrix(os.path.join(baseDir, "terms.npz"), self.ix.schema["content"].analyzer, self.ids)
+        self.activity = activity.ActivityTable(os.path.join(baseDir, "activity.npz"), self.columns)
+        self.mentions = mentionGraph.MentionGraph(os.path.join(baseDir, "mentions.npz"), self.columns)
+        self.stores = [self.counts, self.termMatrix, self.activity, self.mentions]
+        self.syncColumns()
+        with self.reader() as reader:
+            for store in self.stores:
+                store.sync(reader)
+        self.ids.save()
+
         self.stopping = False
         if start:
             self.startIndexer()
-        self.counts = {}
+
+    def reader(self):
+        """ a reader over every shard, to be closed by the caller """
+        return shards.combinedReader([shard.ix.reader() for shard in self.shards])
+
+    def syncColumns(self):
+        """ columns for new segments; cached views are kept for each shard and all of them """
+        readers = [shard.ix.reader() for shard in self.shards]
+        parts = [tuple(r.segment().segid for r, offset in self.columns.leaves(reader)) for reader in readers]
+        with shards.combinedReader(readers) as reader:
+            self.columns.sync(reader, parts)
+
+    def generation(self):
+        return tuple(shard.searchers.generation for shard in self.shards)
+
+    def timeFilter(self, start, end):
+        """ a query for documents between start and end (epoch seconds or ISO dates), or None """
+        if start is None and end is None:
+            return None
+        startDt = datetime.datetime.fromtimestamp(toEpoch(start)) if start is not None else None
+        endDt = datetime.datetime.fromtimestamp(toEpoch(end)) if end is not None else None
+        return whoosh.query.DateRange("time", startDt, endDt, endexcl=True)
+
+    def shardsFor(self, start=None, end=None):
+        """ the shards that may hold documents between start and end, at least the newest one """
+        return [shard for shard in self.shards if shard.overlaps(toEpoch(start), toEpoch(end))] or self.shards[-1:]
+
+    def fanout(self, fn, start=None, end=None, **kwargs):
+        """ Runs fn(searcher) on every shard that may hold documents between
+            start and end, in parallel when there are several. Returns the
+            results in shard order.
+        """
+        start = toEpoch(start)
+        end = toEpoch(end)
+        targets = [shard for shard in self.shards if shard.overlaps(start, end)]
+        def run(shard):
+            with Index.ScopedSearcher(self, [shard], **kwargs) as searcher:
+                return fn(searcher)
+        if len(targets) <= 1:
+            return [run(shard) for shard in targets]
+        return list(self.pool.map(run, targets))
 
     def getCounts(self, uid):
-        if uid in self.counts:
-            return self.counts[uid]
-        else:
-            with self.getSearcher() as searcher:
-                userNode = whoosh.query.Term("user", uid) # userId in the user field
-                
-                results = searcher.search(userNode)
-                self.counts[uid] = len(results)
-                return len(results)
+        return self.counts.get(uid)
 
     def getLast(self, uid, number):
-        with self.getSearcher() as searcher:
-            userNode = whoosh.query.Term("user", uid) # userId in the user field
-                
+        userNode = whoosh.query.Term("user", uid) # userId in the user field
+        def search(searcher):
             results = searcher.search(userNode, 
                                       #sortedby="time", 
                                       limit=number)
-            return deduper(results, dedupe = True)
+            return self.hitFields(searcher, results)
+        return list(deduper(mergeHits(self.fanout(search), number), dedupe = True, nearDups = self.nearDupFilter()))
+
+    def nearDupFilter(self):
+        return simhash.NearDupFilter(self.nearDupDistance) if self.nearDupDistance else None
+
+    def fingerprint(self, text):
+        """ SimHash of text, the same one the columns hold for an indexed copy of it """
+        return simhash.fingerprint(t.text for t in self.ix.schema["content"].analyzer(text))
+
+    def fieldReader(self, reader):
+        """ docnum -> stored fields for the documents of reader, read from the
+            content store or, for documents indexed before it, from whoosh
+        """
+        seqs = self.columns.columns(reader).seq
+        def fields(docnum):
+            seq = int(seqs[docnum])
+            if seq >= 0:
+                try:
+                    return self.content.get(seq)
+                except KeyError:
+                    pass
+            return reader.stored_fields(docnum)
+        return fields
+
+    def hitFields(self, searcher, results):
+        """ (score, stored fields plus "simhash") of every hit, read before the searcher goes back to the pool """
+        fingerprints = self.columns.columns(searcher.reader()).simhash
+        storedFields = self.fieldReader(searcher.reader())
+        ret = []
+        for hit in results:
+            fields = storedFields(hit.docnum)
+            fields["simhash"] = int(fingerprints[hit.docnum])
+            ret.append((hit.score, fields))
+        return ret
 
     def startIndexer(self):
         self.indexer.start()
+        self.merger.start()
         self.stopping = False
         
     def __del__(self):
         self.stopping = True
+        self.merger.stop()
         if self.indexer.is_alive():
             self.indexer.join()
 
+    def close(self):
+        """ Stops indexing and merging and lets go of the searchers, threads
+            and files; the Index can't be used afterwards. Files still in
+            incoming/ are picked up by the next Index over the same dir.
+        """
+        self.stopping = True
+        self.merger.stop()
+        if self.indexer.is_alive():
+            self.indexer.join()
+        self.pool.shutdown(wait = True)
+        for shard in self.shards:
+            shard.searchers.close()
+        self.cache.clear()
+        self.content.close()
+        self.logger.close()
+
+    def warm(self, canaries = ()):
+        """ Pools a searcher on every shard and runs the canary queries, so
+            the first real query finds searchers, columns and postings hot
+        """
+        for shard in self.shards:
+            with Index.ScopedSearcher(self, [shard]) as searcher:
+                self.columns.columns(searcher.reader())
+        with self.getSearcher() as searcher:
+            self.columns.columns(searcher.reader())
+        for text in canaries:
+            self.queryStats(text, expand=True)
+            self.query(text, 10, expand=True, dedupe=True, timer=NoTimer())
+
+    def memoryUsage(self):
+        """ rough bytes held by the result cache, content cache, columns and side tables """
+        return (self.cache.stats()["bytes"] + self.content.memoryUsage() + self.columns.memoryUsage()
+                + sum(store.memoryUsage() for store in self.stores))
+
     def log(self, text):
         print (text)
         self.logger.write(text)
         self.logger.write("\n")
         self.logger.flush()
 
-    def indexLoop(self):
-        print ("Beginning index loop")
-        writer = self.ix.writer()
-        while not self.stopping:
-            path = None
+    def readIncoming(self, path):
+        """ Parses one chatLogger file into documents, or moves it to failed/ if it's broken """
+        try:
+            with open(path, "r", encoding="utf-8") as f:
+                return [toDocument(json.loads(line)) for line in f if line.strip()]
+        except Exception as e:
+            self.log("failed to read {0}: {1}".format(path, e))
+            self.moveToFailed(path)
+            return None
+
+    def moveToFailed(self, path):
+        try:
+            utils.ensureDir(self.failedDir)
+            shutil.move(path, os.path.join(self.failedDir, os.path.basename(path)))
+        except Exception as e:
+            self.log(str(e))
+            raise
+
+    def shardFor(self, doc):
+        """ The shard that takes doc: always the newest one, but a document
+            from a later period than it first opens a shard for that period.
+        """
+        current = self.shards[-1]
+        if self.shardBy:
+            period = shards.periodOf(doc["time"], self.shardBy)
+            if period != current.name and current.name and current.maxTime is None and current.ix.is_empty():
+                # the placeholder opened for a fresh index, named after the first document instead
+                self.shards.pop()
+                current.searchers.close()
+                shutil.rmtree(current.dir)
+                current = shards.Shard(period, os.path.join(self.dir, period), Index.schema)
+                self.shards.append(current)
+                self.ix = current.ix
+            elif period > current.name:
+                current = shards.Shard(period, os.path.join(self.dir, period), Index.schema)
+                self.shards.append(current)
+                self.ix = current.ix
+                self.log("opened shard {0}".format(period))
+        return current
+
+    def commitBatch(self, batch):
+        """ Adds every pending file to a single writer per shard and commits once.
+            Commits never merge segments, the merge scheduler does that.
+        """
+        start = time.time()
+        if self.collapseNearDups:
+            batch = self.collapse(batch)
+        numDocs = 0
+        writers = {}
+        shardPaths = defaultdict(set) # shard name -> paths with documents in its writer
+        committed = set()
+        with self.writeLock:
             try:
-                for file in os.listdir(self.incomingDir):
-                    self.log("indexing {0}\n".format(file))
-                    path = os.path.join(self.incomingDir, file)
-                    with open(path, "r", encoding="utf-8") as f:
-                        for line in f:
-                            doc = json.loads(line)
-                            ts = doc["timestamp"]
-                            t = datetime.datetime.fromtimestamp(ts)
-                            userid = "{0}".format(doc["user"])
-                            writer.add_document(content=doc["content"].strip(), 
-                                                user=userid,
-                                                mentionsUsers=",".join(doc["mentions"]),
-                                                mentionsRoles=",".join(doc["role_mentions"]),
-                                                time=t)
-                    writer.commit()
-                    self.log("committed {0}\n".format(file))
-                    writer = self.ix.writer()
-                    for i in range(0,5):
-                        try:
-                            os.remove(path)
-                            break
-                        except:
-                            pass
-                    self.searchers = []
-                    self.getSearcher()
-                else:
-                    time.sleep(10)
+                for path, docs in batch:
+                    first = self.content.append(docs)
+                    for i, doc in enumerate(docs):
+                        shard = self.shardFor(doc)
+                        writer = writers.get(shard.name)
+                        if writer is None:
+                            writer = writers[shard.name] = shard.ix.writer()
+                        writer.add_document(seq=first + i, **doc)
+                        shard.extend(doc["time"].timestamp())
+                        shardPaths[shard.name].add(path)
+                    numDocs += len(docs)
+                for name, writer in list(writers.items()):
+                    writer.commit(mergetype=whoosh.writing.NO_MERGE)
+                    del writers[name]
+                    committed |= shardPaths[name]
+            except Exception as e:
+                # the ones not committed, including one whose commit failed and still holds its lock
+                for writer in writers.values():
+                    try:
+                        writer.cancel()
+                    except Exception:
+                        pass
+                if committed:
+                    raise PartialCommit(committed, e) from e
+                raise
+            self.lastCommit = time.time()
 
+            try:
+                for shard in self.shards[:-1]:
+                    if not shard.sealed:
+                        sealStart = time.time()
+                        shard.seal()
+                        self.log("sealed shard {0} in {1:.2f}s".format(shard.name, time.time() - sealStart))
+                if self.shardBy:
+                    shards.saveManifest(self.dir, self.shards)
+
+                for store in self.stores:
+                    for path, docs in batch:
+                        store.update(docs)
+                # rows must be on disk before any snapshot that uses them
+                self.ids.save()
+                for store in self.stores:
+                    store.save()
+                self.syncColumns()
             except Exception as e:
-                print(str(e))
-                self.log(str(e))
+                raise PartialCommit(set(path for path, docs in batch), e) from e
+        elapsed = max(time.time() - start, 1e-6)
+        self.log("committed {0} files, {1} docs in {2:.2f}s ({3:.0f} docs/s)".format(len(batch), numDocs, elapsed, numDocs / elapsed))
+
+        for path, docs in batch:
+            for i in range(0,5):
+                try:
+                    os.remove(path)
+                    break
+                except:
+                    pass
+        for shard in self.shards:
+            shard.searchers.refresh()
+        self.cache.clear()
+
+    def collapse(self, batch):
+        """ drops documents of the batch that are near duplicates of an
+            earlier one by the same user in it; they're never indexed
+        """
+        filters = defaultdict(lambda: simhash.NearDupFilter(self.nearDupDistance))
+        collapsed = 0
+        ret = []
+        for path, docs in batch:
+            kept = [doc for doc in docs if not filters[doc["user"]].seen(self.fingerprint(doc["content"]))]
+            collapsed += len(docs) - len(kept)
+            ret.append((path, kept))
+        if collapsed:
+            self.log("collapsed {0} near duplicate docs".format(collapsed))
+        return ret
+
+    def merged(self):
+        """ picks up a commit of the merge scheduler, called with writeLock held """
+        self.syncColumns()
+        for shard in self.shards:
+            shard.searchers.refresh()
+        self.cache.clear()
+
+    def mergeStats(self):
+        return self.merger.stats()
+
+    def commitEach(self, batch, committed = ()):
+        """ After a failed group commit: files whose documents were committed
+            go to failed/ without another try, the others are committed one
+            at a time so only the ones that fail on their own go there too
+        """
+        for path, docs in batch:
+            if path not in committed:
                 try:
-                    if path:
-                        if not os.path.isdir(self.failedDir):
-                            os.mkdir(self.failedDir)
-                        shutil.move(path, os.path.join(self.failedDir, file))
-                except Exception as ee:
-                    print(str(ee))
-                    self.log(str(ee))
-                    raise
+                    self.commitBatch([(path, docs)])
+                    continue
+                except Exception as e:
+                    self.log("commit of {0} failed: {1}".format(path, e))
+            try:
+                self.moveToFailed(path)
+            except Exception:
+                pass # logged by moveToFailed
+
+    def indexLoop(self):
+        """ Waits for chatLogger files in incoming/ and group-commits them.
+            A batch is committed once it holds commitDocs documents or its
+            oldest file has waited commitLatency seconds; a backlog is read
+            only commitDocs documents at a time.
+        """
+        print ("Beginning index loop")
+        watcher = IncomingWatcher(self.incomingDir)
+        batch = []
+        batchDocs = 0
+        batchStart = None
+        try:
+            while not self.stopping:
+                try:
+                    queued = set(path for path, docs in batch)
+                    for file in sorted(os.listdir(self.incomingDir)):
+                        path = os.path.join(self.incomingDir, file)
+                        if path in queued:
+                            continue
+                        docs = self.readIncoming(path)
+                        if docs is None:
+                            continue
+                        batch.append((path, docs))
+                        batchDocs += len(docs)
+                        if batchStart is None:
+                            batchStart = time.time()
+                        if batchDocs >= self.commitDocs:
+                            break
+
+                    waited = time.time() - batchStart if batch else 0
+                    if batch and (batchDocs >= self.commitDocs or waited >= self.commitLatency):
+                        try:
+                            self.commitBatch(batch)
+                        except Exception as e:
+                            self.log("commit of {0} files failed: {1}".format(len(batch), e))
+                            self.commitEach(batch, e.committed if isinstance(e, PartialCommit) else ())
+                        finally:
+                            # whatever happened to them, these files are never committed again
+                            batch = []
+                            batchDocs = 0
+                            batchStart = None
+                    elif batch:
+                        watcher.wait(self.commitLatency - waited)
+                    else:
+                        watcher.wait(10)
+
+                except Exception as e:
+                    print(str(e))
+                    self.log(str(e))
+        finally:
+            watcher.close()
 
 
     class ScopedSearcher:
-        def __init__(self, parent, **kwargs):
+        """ A searcher over the given shards, every shard by default """
+        def __init__(self, parent, shardList=None, **kwargs):
             self.parent = parent
-            self.handle = None
+            self.shardList = shardList
+            self.handles = []
             self.args = kwargs
-            self.time = time.time()
 
         def __enter__(self):
+            self.shardList = self.shardList or list(self.parent.shards)
             try:
-                self.handle = self.parent.searchers.pop()
-                if (time.time() - self.handle.time) > 60:
-                    self.handle = self.handle.refresh()
-                    setattr(self.handle, 'time', time.time())
-                    self.parent.log("Refreshed handle")
-                return self.handle
+                for shard in self.shardList:
+                    self.handles.append(shard.searchers.acquire(**self.args))
             except:
-                self.handle = self.parent.ix.searcher(**self.args)
-                setattr(self.handle, 'time', time.time())
-                return self.handle
-        
+                self.__exit__(None, None, None)
+                raise
+            if len(self.handles) == 1:
+                return self.handles[0]
+            # the pooled handles own the segment readers, so this one never closes them
+            reader = shards.combinedReader([h.reader() for h in self.handles])
+            return whoosh.searching.Searcher(reader, closereader=False, **self.args)
+
         def __exit__(self,a,b,c):
-            self.parent.searchers.append(self.handle)
-            self.handle = None
+            for shard, handle in zip(self.shardList, self.handles):
+                shard.searchers.release(handle)
+            self.handles = []
 
     def getSearcher(self, **kwargs):
         return Index.ScopedSearcher(self, **kwargs)
 
-    def queryStats(self, text, expand=False, timer=NoTimer()):
+    def searcherStats(self):
+        return {shard.name or "main": shard.searchers.stats() for shard in self.shards}
+
+    def queryStats(self, text, expand=False, timer=NoTimer(), start=None, end=None):
         """
             Returns a sorted tuple of (count, userName)
         """
         with timer.sub_timer("query-stats") as t:
-            with self.getSearcher() as searcher:
-                from whoosh.qparser import QueryParser
-                if expand:
-                    qp = QueryParser("content", schema=self.ix.schema, termclass=whoosh.query.Variations)
-                else:
-                    qp = QueryParser("content", schema=self.ix.schema)
-                q = qp.parse(text)
+            if expand:
+                qp = QueryParser("content", schema=self.ix.schema, termclass=whoosh.query.Variations)
+            else:
+                qp = QueryParser("content", schema=self.ix.schema)
+            q = qp.parse(text)
+            timeNode = self.timeFilter(start, end)
+            if timeNode:
+                q = whoosh.query.And([q, timeNode])
+            key = ("queryStats", repr(q.normalize()))
+
+            ret = self.cached(key)
+            if ret is not None:
+                return ret
+            generation = self.generation()
 
-                with t.sub_timer("searcher.search") as s:
-                    results = searcher.search(q, limit=100000)
-
-                with t.sub_timer("results") as s:
-                    counts = defaultdict( lambda: 0)
-                    
-                    with s.sub_timer("counts") as r:
-                        for r in results:
-                            u = r["user"]
-                            counts[u] += 1
-                    
-                    with s.sub_timer("reverse") as r:
-                        counts = [(count, id) for id,count in counts.items() if count > 0]
-                        sc = reversed(sorted(counts))
-                        return [v for v in sc]
+            def count(searcher):
+                docs = np.fromiter(searcher.docs_for_query(q), dtype=np.int64)
+                cols = self.columns.columns(searcher.reader())
+                counts = cols.countUsers(docs)
+                return [(cols.ids[row], int(counts[row])) for row in np.flatnonzero(counts)]
+
+            with t.sub_timer("searcher.search") as s:
+                parts = self.fanout(count, start, end)
+
+            with t.sub_timer("results") as s:
+                counts = defaultdict(int)
+                for part in parts:
+                    for id, count in part:
+                        counts[id] += count
+
+                with s.sub_timer("reverse") as r:
+                    counts = [(count, id) for id,count in counts.items() if count > 0]
+                    sc = reversed(sorted(counts))
+                    return self.cacheResult(key, generation, [v for v in sc])
 
     def deDupeResults(self, text, ret):
         exists = set([text.lower()])
+        nearDups = self.nearDupFilter()
+        if nearDups:
+            nearDups.seen(self.fingerprint(text))
         i = len(ret) - 1
         while i >= 0:
             r = ret[i]
-            if not r[1].lower() in exists:
+            if not r[1].lower() in exists and not (nearDups and nearDups.seen(self.fingerprint(r[1]))):
                 exists.add(r[1].lower())
             else:
                 del ret[i]
             i = i - 1
         return ret
 
-    def queryLong(self, text, max = 3, user = None, expand=False, timer=NoTimer()):
+    def queryLong(self, text, max = 3, user = None, expand=False, timer=NoTimer(), start=None, end=None):
+        """ Up to max unique hits. The search scores a window of hits and
+            doubles it only while duplicates leave it short, like a Cursor;
+            only if it runs dry does a second, expanded search fill the
+            shortfall, masked to skip what the first one already matched.
+        """
         with timer.sub_timer("query-long") as t:
-            for attempt in range(0,3):
-                with t.sub_timer(attempt) as s:
-                    results = self.query(text, max*(2+attempt), user, expand=(expand or (attempt > 0)), timer=t, dedupe=True)
-                    ret = list(results)
+            generation = self.generation()
+            key = ("queryLong", repr(self.parseQuery(text, user).normalize()), max, expand, repr(self.timeFilter(start, end)))
+            ret = self.cached(key)
+            if ret is not None:
+                return ret
 
+            timeNode = self.timeFilter(start, end)
+            passes = [expand] if expand else [False, True]
+            ret = []
+            seen = set()
+            nearDups = self.nearDupFilter()
+            with Index.ScopedSearcher(self, self.shardsFor(start, end), weighting = whoosh.scoring.TF_IDF) as searcher:
+                fingerprints = self.columns.columns(searcher.reader()).simhash
+                storedFields = self.fieldReader(searcher.reader())
+                matched = None
+                for expanded in passes:
+                    with t.sub_timer("expanded" if expanded else "exact") as s:
+                        q = self.parseQuery(text, user, expanded)
+                        if timeNode:
+                            q = whoosh.query.And([q, timeNode])
+                        window = max * 2
+                        position = 0
+                        while len(ret) < max:
+                            results = searcher.search(q, limit=window, mask=matched)
+                            for position in range(position, results.scored_length()):
+                                hit = results[position]
+                                fields = storedFields(hit.docnum)
+                                if fields["content"] in seen:
+                                    continue
+                                seen.add(fields["content"])
+                                if nearDups and nearDups.seen(int(fingerprints[hit.docnum])):
+                                    continue
+                                ret.append((fields["user"], fields["content"]))
+                                if len(ret) >= max:
+                                    break
+                            else:
+                                if results.scored_length() < window:
+                                    break # every match was read
+                                position = results.scored_length()
+                                window *= 2
+                        matched = q
                     if len(ret) >= max:
-                        ret = ret[:max]
                         break
-            return ret
+            return self.cacheResult(key, generation, ret)
 
     def queryUserOrI(self, text, max = 3, userId = None, userName = None, expand=False, dedupe=False):
         with self.getSearcher(weighting = whoosh.scoring.TF_IDF) as searcher:
@@ -275,116 +717,128 @@ class Index:
 
             results = searcher.search(q, limit=max)
 
-            return Results(results)
+            storedFields = self.fieldReader(searcher.reader())
+            hits = (storedFields(hit.docnum) for hit in results)
+            return list(Results(hits, nearDups=self.nearDupFilter(), fingerprint=self.fingerprint))
 
-    def query(self, text, max = 3, user = None, expand=False, userNames=[], dedupe=False, timer=Timer("index.query")):
+    def parseQuery(self, text, user = None, expand=False, userNames=[]):
+        if expand:
+            qp = QueryParser("content", schema=self.ix.schema, termclass=whoosh.query.Variations)
+        else:
+            qp = QueryParser("content", schema=self.ix.schema)
+        nonExpandQP = QueryParser("content", schema=self.ix.schema)
+
+        userNodes = []
+        # Massive spaghetti here
+        textNode = qp.parse(text)
+        textNode.fieldname = "content"
+        if user:
+            userNode = whoosh.query.Term("user", user)
+            userNodes.append(userNode)
+        if userNames:
+            q2 = nonExpandQP.parse(" OR " .join(userNames))
+            q2.field = "content"
+            userNodes.append(q2)
+        q = textNode
+        if userNodes:
+            u = whoosh.query.Or(userNodes)
+            q = whoosh.query.And([q, u])
+        return q
+
+    def cached(self, key):
+        """ cached result for key at the current generation, or None """
+        ret = self.cache.get((self.generation(),) + key)
+        return None if ret is None else list(ret)
+
+    def cacheResult(self, key, generation, ret):
+        self.cache.insert((generation,) + key, ret)
+        return list(ret)
+
+    def cacheStats(self):
+        return self.cache.stats()
+
+    def openCursor(self, text, user = None, expand=False, userNames=[], dedupe=True, start=None, end=None):
+        """ A Cursor over the same hits as query(), ranked over every shard
+            that overlaps start/end; close it when done with it.
+        """
+        q = self.parseQuery(text, user, expand, userNames)
+        timeNode = self.timeFilter(start, end)
+        if timeNode:
+            q = whoosh.query.And([q, timeNode])
+        scoped = Index.ScopedSearcher(self, self.shardsFor(start, end), weighting = whoosh.scoring.TF_IDF)
+        return cursors.Cursor(scoped, q, dedupe, nearDups = self.nearDupFilter() if dedupe else None,
+                              columnStore = self.columns, fieldReader = self.fieldReader)
+
+    def query(self, text, max = 3, user = None, expand=False, userNames=[], dedupe=False, timer=Timer("index.query"), start=None, end=None):
         """ text: the main text query of the content. expand=bool applies to this. 
                   if user or userNames are supplied, text is restricted to content (else no field res)
             user: id of a user to restrict to
             userNames: ORed with 'user', but a text search in content :/
+            start, end: optional time bounds, shards outside them aren't searched
                   """
         with timer.sub_timer("query") as ot:
-            with self.getSearcher(weighting = whoosh.scoring.TF_IDF) as searcher:
-                with ot.sub_timer("inner-q") as t:
-                    with t.sub_timer("query-parse") as s:
-                        if expand:
-                            qp = QueryParser("content", schema=self.ix.schema, termclass=whoosh.query.Variations)
-                        else:
-                            qp = QueryParser("content", schema=self.ix.schema)
-                        nonExpandQP = QueryParser("content", schema=self.ix.schema)
-
-                        userNodes = []
-                        # Massive spaghetti here
-                        textNode = qp.parse(text)
-                        textNode.fieldname = "content"
-                        if user:
-                            userNode = whoosh.query.Term("user", user)
-                            userNodes.append(userNode)
-                        if userNames:
-                            q2 = nonExpandQP.parse(" OR " .join(userNames))
-                            q2.field = "content"
-                            userNodes.append(q2)
-                        q = textNode
-                        if userNodes:
-                            u = whoosh.query.Or(userNodes)
-                            q = whoosh.query.And([q, u])
-                    
-                    with t.sub_timer("searcher.search") as s:
-                        results = searcher.search(q, limit=max)
-
-                    return deduper(results, dedupe=dedupe)
-
-    async def collect_terms(self, t, usernames, corpusThresh, freq, minScore, corpusSize, filters= {}, timer=NoTimer()):
-        with timer.sub_timer("collect_terms outer") as t_:
-            with self.getSearcher() as s:
-                ret = []
-                q = whoosh.query.Term("content", t)
-                for u in usernames:
-                    uq = filters.get(u,whoosh.query.Term("user", u))
-                    with t_.sub_timer("search") as tt_:
-                        res = s.search(q, limit = 100000000, filter=uq)
-
-                    with t_.sub_timer("length") as tt_:
-                        occs = res.scored_length()
-
-                    with t_.sub_timer("counting") as tt_:
-                        if occs and occs > corpusThresh * freq:
-                            
-                            score = (occs / self.getCounts(u)) / (freq/corpusSize)
-                            if score > 0:
-                                score = math.log(score)*10
-                                if score > minScore:
-                                    ret.append((u, t, score))
-                return ret
+            with ot.sub_timer("inner-q") as t:
+                with t.sub_timer("query-parse") as s:
+                    q = self.parseQuery(text, user, expand, userNames)
+                    timeNode = self.timeFilter(start, end)
+                    if timeNode:
+                        q = whoosh.query.And([q, timeNode])
+                    key = ("query", repr(q.normalize()), max, dedupe)
+
+                ret = self.cached(key)
+                if ret is not None:
+                    return ret
+                generation = self.generation()
+
+                def search(searcher):
+                    return self.hitFields(searcher, searcher.search(q, limit=max))
 
-    async def terms_async(self, usernames, corpusThresh = 0.6, corpusNorm = False, minScore = 450, timer=NoTimer()):
-        ret = []
-        with timer.sub_timer("getCounts") as t:
-            totalCounts = {u:self.getCounts(u) for u in usernames}
-        num = re.compile(r"^\d+$")
+                with t.sub_timer("searcher.search") as s:
+                    hits = mergeHits(self.fanout(search, start, end, weighting = whoosh.scoring.TF_IDF), max)
 
-        with timer.sub_timer("getReader") as t:
-            reader = self.ix.reader()
+                nearDups = self.nearDupFilter() if dedupe else None
+                return self.cacheResult(key, generation, list(deduper(hits, dedupe=dedupe, nearDups=nearDups)))
 
-        with timer.sub_timer("numDocs") as t:
-            numDocs = reader.doc_count()
+    async def terms_async(self, usernames, corpusThresh = 0.6, corpusNorm = False, minScore = 450, timer=NoTimer(), cancel=NoCancel()):
+        """ Distinctive content terms for each user id in usernames (every user if None),
+            scored against the whole corpus. Returns [(userId, term, score)]
+        """
+        with timer.sub_timer("termMatrix") as t:
+            uids = None if usernames is None else list(usernames)
+            # scoring is all numpy, keep it off the event loop
+            return await asyncio.get_event_loop().run_in_executor(self.pool, self.termMatrix.score, uids, self.counts.byRow, corpusThresh, minScore, cancel)
+
+    async def terms_stream(self, usernames, corpusThresh = 0.6, minScore = 450, k = 25, cancel=NoCancel()):
+        """ Async generator of the k best terms_async() terms per user as they firm up:
+            (snapshot [(userId, term, score)], fraction done, final) after every chunk of terms
+        """
+        uids = None if usernames is None else list(usernames)
+        steps = self.termMatrix.topTerms(uids, self.counts.byRow, corpusThresh, minScore, k, cancel = cancel)
+        loop = asyncio.get_event_loop()
+        while True:
+            # each step is numpy work, keep it off the event loop
+            step = await loop.run_in_executor(self.pool, next, steps, None)
+            if step is None:
+                return
+            yield step
 
-        with timer.sub_timer("initFilters") as t:
-            with self.getSearcher() as s:
-                filters = {u:s.search(whoosh.query.Term("user", u)) for u in usernames}
+    def terms(self, usernames, corpusThresh = 0.6, corpusNorm = False, minScore = 450, cancel=NoCancel()):
+        ret = []
+        totalCounts = {u:self.getCounts(u) for u in usernames}
+        num = re.compile(r"^\d+$")
+        with self.getSearcher() as s:
+            reader = s.reader()
+            numDocs = reader.doc_count()
 
-        with timer.sub_timer("termLoop") as t_:
             for t in reader.field_terms("content"):
+                cancel.check()
                 if num.match(t):
                     continue
                 if len(t) < 3:
                     continue
-                with t_.sub_timer("termFreq") as t__:
-                    freq = reader.frequency("content", t)
-
+                freq = reader.doc_frequency("content", t)
                 if freq > 50 and freq < numDocs/100:
-                    try:
-                        ret += await self.collect_terms(t, usernames, corpusThresh, freq, minScore, numDocs, filters = filters, timer=t_)
-                    except Exception as e:
-                        print("Error while iterating through terms: {0}".format(e))
-        return ret
-
-    def terms(self, usernames, corpusThresh = 0.6, corpusNorm = False, minScore = 450):
-        ret = []
-        totalCounts = {u:self.getCounts(u) for u in usernames}
-        num = re.compile(r"^\d+$")
-        reader = self.ix.reader()
-        numDocs = reader.doc_count()
-
-        for t in reader.field_terms("content"):
-            if num.match(t):
-                continue
-            if len(t) < 3:
-                continue
-            freq = reader.doc_frequency("content", t)
-            if freq > 50 and freq < numDocs/100:
-              #  print("{0}: {1}".format(t, freq))
-                with self.getSearcher() as s:
+                  #  print("{0}: {1}".format(t, freq))
                     q = whoosh.query.Term("content", t)
                     uq = whoosh.query.Or([whoosh.query.Term("user", u) for u in usernames])
                     qry = whoosh.query.And([q, uq])
@@ -411,40 +865,50 @@ class Index:
 
             q = whoosh.query.And([uq, tq])
             res = s.search(q, limit=10000000)
-            return res
+            storedFields = self.fieldReader(s.reader())
+            return [storedFields(r.docnum) for r in res]
 
-    def getMentionGraph(self, coreUsers : list):
-        qp = QueryParser("mentionsUsers", schema=self.ix.schema)
-        tq = qp.parse("*") # something in mentionUsers
+    def getMentionGraph(self, coreUsers : list, start=None, end=None):
         ret = defaultdict(lambda: defaultdict(int))
-        with self.getSearcher() as s:
-            for uid in coreUsers:
-                uq = whoosh.query.Term("user", uid) # limit to uid
-
-                q = whoosh.query.And([uq, tq])
-                res = s.search(q, limit=10000000)
-                thisUserContrib = ret[uid]
-                for r in res:
-                    mentions = r["mentionsUsers"]
-                    mentions = mentions.split(",")
-                    for m in mentions:
-                        thisUserContrib[m] += 1
+        for uid in coreUsers:
+            ret[uid].update(self.mentions.mentionedBy(uid, start, end))
         return ret
 
+    def topMentioners(self, target, k=10, start=None, end=None):
+        """ [(count, userId)] of whoever mentions target the most """
+        return self.mentions.mentioners(target, k, start, end)
+
+    def reciprocalMentions(self, uid, start=None, end=None):
+        """ [(peerId, uid -> peer mentions, peer -> uid mentions)] """
+        return self.mentions.reciprocal(uid, start, end)
+
     def whoMentions(self, target:str, names:set):
         if type(names) != set:
             names = set(names)
-        with self.getSearcher() as s:
-            q = whoosh.query.Or([whoosh.query.Term("content", n) for n in names])
-            uq = whoosh.query.Term("mentionsUsers", target)
-            qry = whoosh.query.Or([q, uq])
-            res = s.search(qry, limit=10000000)
-
-            counts = defaultdict(int)
-            for r in res:
-                counts[r["user"]] += 1
-
-            return counts
+        if not names:
+            return defaultdict(int, {uid:count for count, uid in self.mentions.mentioners(target)})
+
+        q = whoosh.query.Or([whoosh.query.Term("content", n) for n in names])
+        def count(s):
+            cols = self.columns.columns(s.reader())
+            docs = [cols.mentionDoc[cols.mentionUser == cols.row(target)]]
+            docs.append(np.fromiter(s.docs_for_query(q), dtype=np.int64))
+            docs = np.unique(np.concatenate(docs))
+
+            counts = cols.countUsers(docs)
+            return [(cols.ids[row], int(counts[row])) for row in np.flatnonzero(counts)]
+
+        counts = defaultdict(int)
+        for part in self.fanout(count):
+            for uid, n in part:
+                counts[uid] += n
+        return counts
+
+    def getActivity(self, userIds=None, start=None, end=None):
+        """ 7x24 message counts by UTC weekday and hour for userIds (everyone if None).
+            start/end are epoch seconds or ISO dates.
+        """
+        return self.activity.histogram(userIds, start, end)
 
     def getTimes(self, userId):
         import whoosh.sorting
@@ -1,26 +1,95 @@
+import asyncio
+import inspect
 import server
-import utils
 import os
-import inspect
 import textEngine
+import engines
+import dispatch
 import json
 
 class MyHandler:
+    # methods whose results belong to their caller and are never shared
+    perCaller = frozenset(("openCursor", "fetchCursor", "closeCursor"))
+
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
         print ("Listening now!")
 
     def initialize(self, **kwargs):
         self.indexes = kwargs.get("state", {})
+        self.dispatcher = kwargs.get("dispatcher", None) or dispatch.Dispatcher()
+        self.openCursors = set() # (sid, cursorId) opened over this connection
 
-    async def call(self, sid, name, *args, **kwargs):
-        idx = self.indexes[sid]
-        method = getattr(idx, name)
-        if method:
-            if inspect.iscoroutinefunction(method):
-                return await method(*args, **kwargs)
+    async def call(self, sid, name, *args, deadline = None, **kwargs):
+        # held for the whole call so the engine isn't evicted under it;
+        # opening one reads its index, so that's done off the loop too
+        idx = self.indexes.acquire(sid, open = False)
+        if idx is None:
+            idx = await self.dispatcher.offload(self.indexes.acquire, sid)
+        try:
+            method = getattr(idx, name)
+            # identical calls in flight at the same time share one computation
+            key = None if name in MyHandler.perCaller else dispatch.callKey(sid, name, method, args, kwargs)
+            ret = await self.dispatcher.shared(key, name, method, *args, deadline = deadline, **kwargs)
+        finally:
+            self.indexes.release(sid)
+        if name in ("openCursor", "fetchCursor") and isinstance(ret, dict):
+            if ret["done"]:
+                self.openCursors.discard((sid, ret["cursor"]))
             else:
-                return method(*args, **kwargs)
+                self.openCursors.add((sid, ret["cursor"]))
+        return ret
+
+    async def batch(self, sid, calls, deadline = None):
+        """ Runs [sid, method, args, kwargs] calls (sid None for this
+            connection's, args and kwargs optional) concurrently and returns
+            {"result"} or {"error"} for each, in order
+        """
+        def run(sid, method, args = (), kwargs = {}):
+            return self.call(sid, method, *args, deadline = deadline, **kwargs)
+        results = await asyncio.gather(*[run(call[0] or sid, *call[1:]) for call in calls], return_exceptions = True)
+        # a sub-call that was cancelled comes back as a CancelledError, which isn't an Exception
+        return [{"error": repr(r)} if isinstance(r, BaseException) else {"result": r} for r in results]
+
+    async def stream(self, sid, name, *args, deadline = None, progress = None, **kwargs):
+        """ Like call() for engine methods that are async generators: each
+            item but the last goes out as progress, the last is the result
+        """
+        idx = self.indexes.acquire(sid, open = False)
+        if idx is None:
+            idx = await self.dispatcher.offload(self.indexes.acquire, sid)
+        try:
+            method = getattr(idx, name)
+            async def consume(cancel):
+                if "cancel" in inspect.signature(method).parameters:
+                    kwargs["cancel"] = cancel
+                steps = method(*args, **kwargs)
+                last = None
+                try:
+                    async for step in steps:
+                        if last is not None and progress:
+                            progress(last)
+                        last = step
+                finally:
+                    await steps.aclose()
+                return last
+            # streams aren't shared, every caller wants its own progress
+            return await self.dispatcher.shared(None, name, consume, deadline = deadline)
+        finally:
+            self.indexes.release(sid)
+
+    def serverStats(self, sid):
+        """ queue depths of the dispatcher and the open engines """
+        return {"dispatch": self.dispatcher.stats(), "engines": self.indexes.stats()}
+
+    def on_close(self):
+        # a client that goes away can't close its cursors any more
+        for sid, cursorId in self.openCursors:
+            idx = self.indexes.get(sid)
+            if idx:
+                idx.closeCursor(cursorId)
+        self.openCursors = set()
+        super().on_close()
 
     def poo(self, text):
         return text
@@ -30,9 +99,26 @@ if __name__ == "__main__":
         global_opts = json.loads(f.read(), encoding = "utf-8")
     
     def make(key):
-        opts = { "dir": os.path.join("data", str(key), "index"), 
-                "startIndexing":global_opts.get("startIndexing", False) }
+        # engines read their own keys (commitDocs, shardBy, segmentsPerTier,
+        # offPeakHours, cacheEntries, cursorTimeout, nearDupDistance...)
+        # straight from options.json and default the rest
+        opts = dict(global_opts, dir = os.path.join("data", str(key), "index"))
         return textEngine.TextEngine(opts)
 
-    state = utils.SophDefaultDict(make)
-    server.run(8888, MyHandler, state)
\ No newline at end of file
+    # engines are closed least recently used first while they'd take more than engineMemoryBudget bytes
+    state = engines.EngineTable(make,
+                                memoryBudget = global_opts.get("engineMemoryBudget", None),
+                                idleSeconds = float(global_opts.get("engineIdleSeconds", 300)))
+    # "prewarm": server ids to open before listening, or true for every server under data/
+    prewarm = global_opts.get("prewarm", [])
+    if prewarm is True:
+        prewarm = sorted(d for d in os.listdir("data") if os.path.isdir(os.path.join("data", d, "index")))
+    state.prewarm([str(key) for key in prewarm],
+                  canaries = global_opts.get("canaryQueries", ["lol", "good night"]),
+                  threads = int(global_opts.get("prewarmThreads", 4)))
+    # blocking engine methods run on rpcThreads threads, "methodLimits" caps single methods
+    dispatcher = dispatch.Dispatcher(int(global_opts.get("rpcThreads", 8)), global_opts.get("methodLimits", {}))
+    # frames bigger than this are zlib compressed on connections that negotiated a binary format
+    server.Server.compressAbove = global_opts.get("compressAbove", server.Server.compressAbove)
+    # "indexSocket": a unix socket path served alongside the websocket, for a bot on the same box
+    server.run(8888, MyHandler, state, dispatcher, unixSocket = global_opts.get("indexSocket", None))
\ No newline at end of file
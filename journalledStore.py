@@ -0,0 +1,100 @@
+import json
+import os
+import threading
+import numpy as np
+import scipy.sparse
+
+class JournalledStore:
+    """ Base for side tables that indexLoop keeps in step with the index.
+
+        The table is snapshotted to an .npz file tagged with the document
+        count it reflects. In between snapshots each commit's changes are
+        appended to a journal and replayed on load, and every compactEvery
+        commits the journal is folded into a fresh snapshot. A table that
+        doesn't match the index is rebuilt from it.
+
+        Subclasses implement reset(), build(reader), apply(entry),
+        arrays() -> dict of arrays to snapshot and restore(z).
+        Entries are json-able dicts with a "docs" count.
+    """
+    def __init__(self, path, compactEvery = 200):
+        self.path = path
+        self.journalPath = path + ".journal"
+        self.compactEvery = compactEvery
+        self.lock = threading.Lock()
+        self.unsaved = []
+        self.journalLength = 0
+        self.docCount = -1
+        self.reset()
+
+    def record(self, entry):
+        """ applies one commit's changes and queues them for the journal """
+        self.apply(entry)
+        self.docCount += entry["docs"]
+        self.unsaved.append(entry)
+
+    def load(self):
+        self.unsaved = []
+        self.journalLength = 0
+        try:
+            with np.load(self.path, allow_pickle=False) as z:
+                self.restore(z)
+                self.docCount = int(z["docCount"])
+        except (IOError, ValueError, KeyError):
+            self.reset()
+            self.docCount = -1
+            return False
+
+        if os.path.exists(self.journalPath):
+            with open(self.journalPath, "r", encoding="utf-8") as f:
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        break # torn write, the doc count check in sync catches it
+                    self.apply(entry)
+                    self.docCount += entry["docs"]
+                    self.journalLength += 1
+        return True
+
+    def save(self):
+        if self.journalLength + len(self.unsaved) < self.compactEvery and os.path.exists(self.path):
+            with open(self.journalPath, "a", encoding="utf-8") as f:
+                for entry in self.unsaved:
+                    f.write(json.dumps(entry))
+                    f.write("\n")
+            self.journalLength += len(self.unsaved)
+            self.unsaved = []
+            return
+        self.compact()
+
+    def compact(self):
+        """ writes a fresh snapshot and drops the journal """
+        tmp = self.path + ".tmp.npz"
+        np.savez(tmp, docCount=self.docCount, **self.arrays())
+        os.replace(tmp, self.path)
+        if os.path.exists(self.journalPath):
+            os.remove(self.journalPath)
+        self.journalLength = 0
+        self.unsaved = []
+
+    def memoryUsage(self):
+        """ rough bytes held by the table's numpy and sparse attributes """
+        total = 0
+        for value in vars(self).values():
+            if isinstance(value, np.ndarray):
+                total += value.nbytes
+            elif scipy.sparse.issparse(value):
+                total += sum(getattr(value, a).nbytes for a in ("data", "indices", "indptr", "row", "col") if hasattr(value, a))
+        return total
+
+    def sync(self, reader):
+        """ loads the saved table, rebuilding it if it's missing or stale """
+        if not self.load() or self.docCount != reader.doc_count_all():
+            with self.lock:
+                self.reset()
+            self.build(reader)
+            self.docCount = reader.doc_count_all()
+            self.unsaved = []
+            self.journalLength = 0
+            self.compact()
@@ -0,0 +1,138 @@
+from collections import defaultdict
+import numpy as np
+import scipy.sparse
+from journalledStore import JournalledStore
+from activity import toEpoch
+
+def toMonth(epochSeconds):
+    """ months since 1970-01 (UTC) for an array of epoch seconds """
+    return np.asarray(epochSeconds, dtype=np.int64).astype("datetime64[s]").astype("datetime64[M]").astype(np.int64)
+
+class MentionGraph(JournalledStore):
+    """ Mentioner -> mentioned -> number of messages, bucketed by UTC month.
+        Stored as aggregated (src, dst, month, count) arrays of IdTable rows,
+        with a summed users x users CSR cached for queries that don't ask for
+        a date range.
+        It's built from the mention columns of the index and then updated
+        from the documents of every commit.
+    """
+    def __init__(self, path, columnStore, compactEvery = 200):
+        self.columnStore = columnStore
+        self.ids = columnStore.ids
+        super().__init__(path, compactEvery)
+
+    def reset(self):
+        self.src = np.zeros(0, dtype=np.int32)
+        self.dst = np.zeros(0, dtype=np.int32)
+        self.month = np.zeros(0, dtype=np.int32)
+        self.count = np.zeros(0, dtype=np.int64)
+        self.delta = defaultdict(int) # (src, dst, month) -> count
+        self.total = None
+
+    def row(self, uid):
+        return self.ids.intern(uid)
+
+    def setEdges(self, src, dst, month, count):
+        """ aggregates duplicate (src, dst, month) edges """
+        if not len(src):
+            self.src, self.dst, self.month, self.count = src, dst, month, count
+            return
+        edges = np.stack([src, dst, month], axis=1)
+        edges, inverse = np.unique(edges, axis=0, return_inverse=True)
+        self.src = edges[:,0].astype(np.int32)
+        self.dst = edges[:,1].astype(np.int32)
+        self.month = edges[:,2].astype(np.int32)
+        self.count = np.bincount(inverse.ravel(), weights=count, minlength=len(edges)).astype(np.int64)
+
+    def apply(self, entry):
+        """ entry["edges"]: [src uid, dst uid, month, count] """
+        with self.lock:
+            for src, dst, month, n in entry["edges"]:
+                self.delta[(self.row(src), self.row(dst), month)] += n
+
+    def snapshot(self):
+        """ returns (src, dst, month, count, total csr) with pending updates folded in """
+        with self.lock:
+            if self.delta:
+                keys = np.array(list(self.delta.keys()), dtype=np.int64).reshape(-1, 3)
+                self.setEdges(np.concatenate([self.src, keys[:,0]]),
+                              np.concatenate([self.dst, keys[:,1]]),
+                              np.concatenate([self.month, keys[:,2]]),
+                              np.concatenate([self.count, np.array(list(self.delta.values()), dtype=np.int64)]))
+                self.delta = defaultdict(int)
+                self.total = None
+            n = len(self.ids)
+            if self.total is None or self.total.shape[0] != n:
+                self.total = scipy.sparse.csr_matrix((self.count, (self.src, self.dst)), shape=(n, n), dtype=np.int64)
+            return self.src, self.dst, self.month, self.count, self.total
+
+    def arrays(self):
+        src, dst, month, count, total = self.snapshot()
+        return dict(src=src, dst=dst, month=month, count=count)
+
+    def restore(self, z):
+        self.src, self.dst, self.month, self.count = z["src"], z["dst"], z["month"], z["count"]
+        self.delta = defaultdict(int)
+        self.total = None
+
+    def build(self, reader):
+        cols = self.columnStore.columns(reader)
+        self.setEdges(cols.user[cols.mentionDoc].astype(np.int32),
+                      cols.mentionUser.astype(np.int32),
+                      toMonth(cols.time[cols.mentionDoc]).astype(np.int32),
+                      np.ones(len(cols.mentionDoc), dtype=np.int64))
+
+    def update(self, docs):
+        edges = defaultdict(int)
+        for doc in docs:
+            mentions = [m for m in doc["mentionsUsers"].split(",") if m]
+            if not mentions:
+                continue
+            month = int(toMonth(int(doc["time"].timestamp())))
+            for m in set(mentions):
+                edges[(doc["user"], m, month)] += 1
+        self.record({"docs": len(docs), "edges": [[s, d, m, n] for (s, d, m), n in edges.items()]})
+
+    def matrix(self, start=None, end=None):
+        """ users x users mention counts, optionally limited to the months overlapping start/end """
+        src, dst, month, count, total = self.snapshot()
+        userIds = self.ids
+        if start is None and end is None:
+            return total, userIds
+        keep = np.ones(len(src), dtype=bool)
+        if start is not None:
+            keep &= month >= toMonth(int(toEpoch(start)))
+        if end is not None:
+            keep &= month <= toMonth(int(toEpoch(end)))
+        n = total.shape[0]
+        return scipy.sparse.csr_matrix((count[keep], (src[keep], dst[keep])), shape=(n, n), dtype=np.int64), userIds
+
+    def mentionedBy(self, uid, start=None, end=None):
+        """ {mentioned uid: count} for everything uid mentioned """
+        m, userIds = self.matrix(start, end)
+        r = self.ids.lookup(uid)
+        if r is None or r >= m.shape[0]:
+            return {}
+        row = m.getrow(r)
+        return {userIds[c]:int(n) for c, n in zip(row.indices, row.data)}
+
+    def mentioners(self, uid, k=None, start=None, end=None):
+        """ [(count, uid)] of who mentions uid the most """
+        m, userIds = self.matrix(start, end)
+        c = self.ids.lookup(uid)
+        if c is None or c >= m.shape[0]:
+            return []
+        col = m.getcol(c).tocoo()
+        ret = sorted(((int(n), userIds[r]) for r, n in zip(col.row, col.data)), reverse=True)
+        return ret[:k] if k else ret
+
+    def reciprocal(self, uid, start=None, end=None):
+        """ [(peer uid, times uid mentioned peer, times peer mentioned uid)] """
+        m, userIds = self.matrix(start, end)
+        r = self.ids.lookup(uid)
+        if r is None or r >= m.shape[0]:
+            return []
+        out = m.getrow(r).toarray().ravel()
+        into = m.getcol(r).toarray().ravel()
+        peers = np.flatnonzero(out + into)
+        return sorted(((userIds[p], int(out[p]), int(into[p])) for p in peers), key=lambda x: -(x[1] + x[2]))
@@ -0,0 +1,156 @@
+import math
+import threading
+import time
+import datetime
+from whoosh.reading import SegmentReader
+
+class TieredPolicy:
+    """ Groups segments into size tiers (floorDocs, floorDocs*segmentsPerTier,
+        ...) and merges the smallest maxMergeAtOnce segments of any tier that
+        has more than segmentsPerTier of them. Segments over maxMergedDocs are
+        left alone. Instances are whoosh mergetypes, so
+        writer.commit(mergetype=policy) runs the merges plan() picks.
+    """
+    def __init__(self, segmentsPerTier = 10, maxMergeAtOnce = 10, floorDocs = 2000, maxMergedDocs = 5000000):
+        self.segmentsPerTier = segmentsPerTier
+        self.maxMergeAtOnce = max(2, maxMergeAtOnce)
+        self.floorDocs = floorDocs
+        self.maxMergedDocs = maxMergedDocs
+
+    def tier(self, segment):
+        docs = max(segment.doc_count_all(), self.floorDocs)
+        return int(math.log(docs / self.floorDocs, max(self.segmentsPerTier, 2)))
+
+    def plan(self, segments):
+        """ returns a list of segment groups to merge, smallest tier first """
+        tiers = {}
+        for seg in segments:
+            if seg.doc_count_all() < self.maxMergedDocs:
+                tiers.setdefault(self.tier(seg), []).append(seg)
+        groups = []
+        for tier in sorted(tiers):
+            segs = sorted(tiers[tier], key=lambda s: s.doc_count_all())
+            if len(segs) > self.segmentsPerTier:
+                group = segs[:self.maxMergeAtOnce]
+                if sum(s.doc_count_all() for s in group) <= self.maxMergedDocs:
+                    groups.append(group)
+        return groups
+
+    def __call__(self, writer, segments):
+        merging = set()
+        for group in self.plan(segments):
+            for seg in group:
+                reader = SegmentReader(writer.storage, writer.schema, seg)
+                writer.add_reader(reader)
+                reader.close()
+                merging.add(seg.segid)
+        return [seg for seg in segments if seg.segid not in merging]
+
+def parseHours(text):
+    """ "2-6" -> (2, 6), local hours; None or "" means any time """
+    if not text:
+        return None
+    start, end = text.split("-")
+    return (int(start), int(end))
+
+class MergeScheduler:
+    """ Merges the segments of an Index on its own thread.
+
+        Ingest commits never merge. Every interval seconds the scheduler
+        asks the policy about the writable shards and, once no commit has
+        happened for quietSeconds and the local hour is within offPeakHours
+        (start, end), merges one shard at a time under the index write lock.
+        Searches keep using the previous generation until the merge commits.
+    """
+    def __init__(self, index, policy = None, offPeakHours = None, quietSeconds = 30, interval = 60):
+        self.index = index
+        self.policy = policy or TieredPolicy()
+        self.offPeakHours = offPeakHours
+        self.quietSeconds = quietSeconds
+        self.interval = interval
+        self.wake = threading.Event()
+        self.stopping = False
+        self.thread = threading.Thread(target = MergeScheduler.run, args = [self], daemon = True)
+        self.lock = threading.Lock()
+        self.merges = 0
+        self.mergedSegments = 0
+        self.mergeSeconds = 0.0
+        self.lastMerge = None
+
+    def start(self):
+        self.thread.start()
+
+    def stop(self):
+        self.stopping = True
+        self.wake.set()
+        if self.thread.is_alive():
+            self.thread.join()
+
+    def offPeak(self):
+        if not self.offPeakHours:
+            return True
+        start, end = self.offPeakHours
+        hour = datetime.datetime.now().hour
+        if start <= end:
+            return start <= hour < end
+        return hour >= start or hour < end
+
+    def quiet(self):
+        return time.time() - self.index.lastCommit >= self.quietSeconds
+
+    def run(self):
+        while not self.stopping:
+            self.wake.wait(self.interval)
+            self.wake.clear()
+            if self.stopping:
+                break
+            try:
+                if self.offPeak() and self.quiet():
+                    self.mergeAll()
+            except Exception as e:
+                self.index.log("merge failed: {0}".format(e))
+
+    def segments(self, shard):
+        with shard.ix.reader() as reader:
+            return [r.segment() for r, offset in reader.leaf_readers() if r.segment() is not None]
+
+    def mergeAll(self):
+        """ runs every merge the policy wants on the writable shards; returns the number of merges """
+        merged = 0
+        for shard in list(self.index.shards):
+            if self.stopping:
+                break
+            if not shard.sealed and self.policy.plan(self.segments(shard)):
+                self.merge(shard)
+                merged += 1
+        return merged
+
+    def merge(self, shard):
+        with self.index.writeLock:
+            start = time.time()
+            before = self.segments(shard)
+            writer = shard.ix.writer()
+            try:
+                writer.commit(mergetype = self.policy)
+            except:
+                writer.cancel()
+                raise
+            after = self.segments(shard)
+            elapsed = time.time() - start
+            self.index.merged()
+        with self.lock:
+            self.merges += 1
+            self.mergedSegments += len(before) - len(after) + 1
+            self.mergeSeconds += elapsed
+            self.lastMerge = {"shard": shard.name, "segmentsBefore": len(before), "segmentsAfter": len(after),
+                              "seconds": elapsed, "at": time.time()}
+        self.index.log("merged shard {0}: {1} -> {2} segments in {3:.2f}s".format(shard.name or "main", len(before), len(after), elapsed))
+
+    def stats(self):
+        segments = {shard.name or "main": len(self.segments(shard)) for shard in list(self.index.shards)}
+        with self.lock:
+            return {"segments": segments,
+                    "merges": self.merges,
+                    "mergedSegments": self.mergedSegments,
+                    "mergeSeconds": self.mergeSeconds,
+                    "lastMerge": self.lastMerge}
@@ -0,0 +1,112 @@
+""" Rebuilds data/<server>/index from an archive of chatLogger files.
+
+    python rebuildIndex.py <serverId> <archiveDir> [--procs N]
+
+    JSON decoding is fanned out over a process pool and analysis runs in
+    whoosh's multiprocessing writer, one segment per process. The segments
+    are merged once at the end and the new index and its content store are
+    swapped into place; the side tables are rebuilt on the next open.
+    Stop indexBundle.py for the server before running this.
+"""
+import argparse
+import json
+import multiprocessing
+import os
+import shutil
+import time
+import whoosh.index
+import index
+import contentStore
+
+def loadFile(path):
+    """ Decodes one chatLogger file into (path, documents, badLines) """
+    docs = []
+    bad = 0
+    with open(path, "r", encoding="utf-8") as f:
+        for line in f:
+            if not line.strip():
+                continue
+            try:
+                docs.append(index.toDocument(json.loads(line)))
+            except Exception:
+                bad += 1
+    return path, docs, bad
+
+def rebuild(archiveDir, indexDir, procs=None, limitmb=256, log=print):
+    procs = procs or multiprocessing.cpu_count()
+    files = sorted(os.path.join(archiveDir, f) for f in os.listdir(archiveDir))
+    files = [f for f in files if os.path.isfile(f)]
+
+    tempDir = indexDir.rstrip(os.sep) + ".rebuild"
+    shutil.rmtree(tempDir, ignore_errors=True)
+    os.mkdir(tempDir)
+    ix = whoosh.index.create_in(tempDir, index.Index.schema)
+    contentDir = os.path.join(os.path.dirname(indexDir.rstrip(os.sep)), "content")
+    tempContentDir = contentDir + ".rebuild"
+    shutil.rmtree(tempContentDir, ignore_errors=True)
+    content = contentStore.ContentStore(tempContentDir)
+
+    log("rebuilding {0} from {1} files with {2} processes".format(indexDir, len(files), procs))
+    start = time.time()
+    numDocs = 0
+    numBad = 0
+    writer = ix.writer(procs=procs, multisegment=True, limitmb=limitmb)
+    try:
+        with multiprocessing.Pool(procs) as pool:
+            for i, (path, docs, bad) in enumerate(pool.imap(loadFile, files, chunksize=4)):
+                first = content.append(docs)
+                for n, doc in enumerate(docs):
+                    writer.add_document(seq=first + n, **doc)
+                numDocs += len(docs)
+                numBad += bad
+                if i % 100 == 99:
+                    elapsed = time.time() - start
+                    log("{0}/{1} files, {2} docs ({3:.0f} docs/s)".format(i + 1, len(files), numDocs, numDocs / elapsed))
+        writer.commit()
+    except:
+        writer.cancel()
+        raise
+    indexed = time.time()
+    log("indexed {0} docs in {1:.1f}s ({2:.0f} docs/s), {3} bad lines".format(numDocs, indexed - start, numDocs / max(indexed - start, 1e-6), numBad))
+
+    ix.optimize()
+    ix.close()
+    merged = time.time()
+    log("merged {0} segments in {1:.1f}s".format(procs, merged - indexed))
+
+    for dir, newDir in ((indexDir, tempDir), (contentDir, tempContentDir)):
+        oldDir = dir.rstrip(os.sep) + ".old"
+        shutil.rmtree(oldDir, ignore_errors=True)
+        if os.path.isdir(dir):
+            os.rename(dir, oldDir)
+        os.rename(newDir, dir)
+        shutil.rmtree(oldDir, ignore_errors=True)
+
+    # they describe the old index, one with the same document count would pass for this one
+    baseDir = os.path.dirname(indexDir.rstrip(os.sep))
+    for name in index.SIDE_TABLES:
+        for path in (name, name + ".journal"):
+            path = os.path.join(baseDir, path)
+            if os.path.exists(path):
+                os.remove(path)
+
+    total = time.time() - start
+    log("rebuilt {0}: {1} docs in {2:.1f}s ({3:.0f} docs/s overall)".format(indexDir, numDocs, total, numDocs / max(total, 1e-6)))
+    return numDocs
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Rebuild a server's whoosh index from chatLogger files")
+    parser.add_argument("server")
+    parser.add_argument("archive")
+    parser.add_argument("--procs", type=int, default=None)
+    parser.add_argument("--limitmb", type=int, default=256)
+    args = parser.parse_args()
+
+    indexDir = os.path.join("data", args.server, "index")
+    with open(os.path.join("data", args.server, "index.log"), "a") as logger:
+        def log(text):
+            print (text)
+            logger.write(text)
+            logger.write("\n")
+            logger.flush()
+        rebuild(args.archive, indexDir, procs=args.procs, limitmb=args.limitmb, log=log)
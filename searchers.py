@@ -0,0 +1,95 @@
+import threading
+import time
+from collections import defaultdict
+
+def poolKey(kwargs):
+    """ searchers built with different weightings can't be swapped """
+    return tuple(sorted((k, getattr(v, "__name__", repr(v))) for k, v in kwargs.items()))
+
+class SearcherManager:
+    """ Hands out searchers over the latest commit of an index.
+
+        Every searcher owns its reader and is tagged with the generation it
+        was opened at. Idle searchers of the current generation are pooled
+        (at most poolSize per weighting), checkouts are lock-protected and
+        refresh() after a commit retires the previous generation: its idle
+        searchers are closed straight away and checked out ones as soon as
+        they come back, so no reader outlives its last user. Commits of
+        another process are picked up by acquire(), which looks for a newer
+        generation at most every checkInterval seconds.
+    """
+    def __init__(self, ix, poolSize = 4, checkInterval = 1.0):
+        self.ix = ix
+        self.poolSize = poolSize
+        self.checkInterval = checkInterval
+        self.lastCheck = time.monotonic()
+        self.lock = threading.Lock()
+        self.generation = ix.latest_generation()
+        self.idle = defaultdict(list)  # poolKey -> [searcher] of the current generation
+        self.refs = defaultdict(int)   # generation -> checked out searchers
+        self.opened = 0
+        self.closed = 0
+
+    def acquire(self, **kwargs):
+        if time.monotonic() - self.lastCheck >= self.checkInterval:
+            self.lastCheck = time.monotonic()
+            self.refresh()
+        key = poolKey(kwargs)
+        with self.lock:
+            generation = self.generation
+            pool = self.idle[key]
+            handle = pool.pop() if pool else None
+            self.refs[generation] += 1
+        if handle is None:
+            try:
+                handle = self.ix.searcher(**kwargs)
+            except:
+                with self.lock:
+                    self.refs[generation] -= 1
+                raise
+            handle.generation = generation
+            handle.poolKey = key
+            with self.lock:
+                self.opened += 1
+        return handle
+
+    def release(self, handle):
+        with self.lock:
+            self.refs[handle.generation] -= 1
+            if not self.refs[handle.generation]:
+                del self.refs[handle.generation]
+            pool = self.idle[handle.poolKey]
+            if handle.generation == self.generation and len(pool) < self.poolSize:
+                pool.append(handle)
+                return
+            self.closed += 1
+        handle.close()
+
+    def refresh(self):
+        """ switches to the latest commit; call after every commit """
+        generation = self.ix.latest_generation()
+        with self.lock:
+            if generation == self.generation:
+                return
+            self.generation = generation
+            retired = [h for pool in self.idle.values() for h in pool]
+            self.idle = defaultdict(list)
+            self.closed += len(retired)
+        for handle in retired:
+            handle.close()
+
+    def close(self):
+        with self.lock:
+            retired = [h for pool in self.idle.values() for h in pool]
+            self.idle = defaultdict(list)
+            self.closed += len(retired)
+        for handle in retired:
+            handle.close()
+
+    def stats(self):
+        with self.lock:
+            return {"generation": self.generation,
+                    "idle": sum(len(p) for p in self.idle.values()),
+                    "checkedOut": dict(self.refs),
+                    "opened": self.opened,
+                    "closed": self.closed}
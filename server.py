@@ -5,57 +5,186 @@ import tornado.httpserver
 import json
 import asyncio
 import inspect
-
-class Server(tornado.websocket.WebSocketHandler):
-    server = None
-
+import os
+import time
+import wire
+
+class Rpc:
+    """ Runs the requests of one connection as calls of its methods and
+        writes the answers back. The transport provides path_args,
+        wireProtocol, compressAbove and write_message().
+    """
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
-
-    def stop(self):
-        Server.server.stop()
-
-    def open(self, p):
-        print("WebSocket opened")
+        self.tasks = {} # id -> task of a coroutine call still running for this connection
 
     def on_message(self, message):
+        # one bad frame mustn't take down a connection others' calls share:
+        # its caller gets the error, or the log if it can't be told apart
+        id = None
         try:
-            print (message)
-        except:
-            pass
-        j = json.loads(message)
+            j = wire.decode(self.wireProtocol, message)
+            id = j.get("id", None)
+            self.dispatch(j, id)
+        except Exception as e:
+            if id is None:
+                print("Bad request:", repr(e))
+            else:
+                self.reply(id, error = repr(e))
+
+    def dispatch(self, j, id):
         methodName = j["method"]
         args = j.get("args", ())
         kwargs = j.get("kwargs", {})
         res = self.path_args[0]
 
         method = getattr(self, methodName)
+        # "timeout" is how many seconds the caller will wait; methods that
+        # take a deadline get it as a time.monotonic() to give up at
+        timeout = j.get("timeout", None)
+        parameters = inspect.signature(method).parameters
+        if timeout is not None and "deadline" in parameters:
+            kwargs["deadline"] = time.monotonic() + timeout
+        # methods that report progress send it as {"id", "progress"} frames
+        # ahead of their answer, which only callers that sent an id can match
+        if id is not None and "progress" in parameters:
+            kwargs["progress"] = lambda value: self.reply(id, progress = value)
         if inspect.iscoroutinefunction(method):
             loop = asyncio.get_event_loop()
             task = loop.create_task(method(res, *args, **kwargs))
+            if id is not None:
+                self.tasks[id] = task
 
             def onFinish(r):
-                ret = r.result()
-                if type(ret) != str:
-                    ret = json.dumps(ret)
-                self.write_message(ret)
+                self.tasks.pop(id, None)
+                if r.cancelled():
+                    return # cancelled by the client or its going away, nobody to answer
+                if id is None:
+                    self.reply(None, r.result())
+                elif r.exception() is not None:
+                    self.reply(id, error = repr(r.exception()))
+                else:
+                    self.reply(id, r.result())
 
             task.add_done_callback( onFinish )
             future = asyncio.ensure_future(task)
 
         elif method:
-            ret = method(res, *args, **kwargs)
-            if type(ret) != str:
-                ret = json.dumps(ret)
-            self.write_message(ret)
+            self.reply(id, method(res, *args, **kwargs))
+
+    def reply(self, id, ret = None, error = None, progress = None):
+        """ Requests that carry an id are answered with {"id", "result"} or
+            {"id", "error"} so clients can match answers out of order, maybe
+            after some {"id", "progress"}; the others get the bare result
+        """
+        if id is None:
+            frame = wire.encode(self.wireProtocol, ret, self.compressAbove)
+        elif progress is not None:
+            frame = wire.encode(self.wireProtocol, {"id": id, "progress": progress}, self.compressAbove)
+        elif error is not None:
+            frame = wire.encode(self.wireProtocol, {"id": id, "error": error}, self.compressAbove)
+        else:
+            frame = wire.encode(self.wireProtocol, {"id": id, "result": ret}, self.compressAbove)
+        try:
+            self.write_message(frame, binary = isinstance(frame, bytes))
+        except tornado.websocket.WebSocketClosedError:
+            pass # the client went away, a pooled one resends over its next connection
 
-        print("Returned")
 
+    def cancel(self, res, id):
+        """ cancels the running call with that id; the client gave up on it """
+        task = self.tasks.get(id)
+        if task:
+            task.cancel()
+        return task is not None
 
     def on_close(self):
+        # nobody is left to answer, work that only this connection waits for stops
+        for task in list(self.tasks.values()):
+            task.cancel()
         print("WebSocket closed")
 
-def run(port, cls, state):
+class Server(Rpc, tornado.websocket.WebSocketHandler):
+    server = None
+    compressAbove = wire.COMPRESS_ABOVE
+    wireProtocol = None # negotiated in select_subprotocol, kept past the connection's end
+
+    def stop(self):
+        Server.server.stop()
+
+    def open(self, p):
+        print("WebSocket opened")
+
+    def select_subprotocol(self, subprotocols):
+        self.wireProtocol = wire.select(subprotocols)
+        return self.wireProtocol
+
+class FramedServer(Rpc):
+    """ A connection over the unix socket, for clients on the same box that
+        can skip HTTP and websocket framing. Every frame is wire.framed():
+        the client's first one is json {"path", "protocols"} and is answered
+        with json {"protocol"}, the one of theirs this side likes best, and
+        the rest are that protocol's wire.encode()d messages, never
+        compressed as there's no network to save.
+    """
+    compressAbove = None
+
+    def __init__(self, writer, path, protocol, **kwargs):
+        super().__init__()
+        self.writer = writer
+        self.path_args = [path]
+        self.wireProtocol = protocol
+        self.initialize(**kwargs)
+
+    def initialize(self, **kwargs):
+        pass
+
+    def write_message(self, frame, binary = True):
+        if not self.writer.is_closing():
+            self.writer.write(wire.framed(frame))
+
+class FramedPing(FramedServer):
+    """ the unix socket's /ping """
+    def on_message(self, message):
+        try:
+            j = wire.decode(self.wireProtocol, message)
+        except Exception:
+            j = None
+        self.reply(j.get("id", None) if isinstance(j, dict) else None, "OK")
+
+async def serveUnix(socketPath, handler, kwargs):
+    """ Serves handler, a FramedServer, on the unix socket at socketPath;
+        path "ping" gets FramedPing
+    """
+    if os.path.exists(socketPath):
+        os.remove(socketPath) # left by a server that didn't shut down cleanly
+    async def connected(reader, writer):
+        conn = None
+        try:
+            hello = await wire.readFramed(reader)
+            if hello is None:
+                return
+            hello = json.loads(hello)
+            protocol = wire.select(hello.get("protocols", [])) or wire.JSON
+            writer.write(wire.framed(json.dumps({"protocol": protocol})))
+            path = hello.get("path", "")
+            if path == "ping":
+                conn = FramedPing(writer, path, protocol)
+            else:
+                conn = handler(writer, path, protocol, **kwargs)
+            while True:
+                frame = await wire.readFramed(reader)
+                if frame is None:
+                    break
+                conn.on_message(frame)
+        finally:
+            if conn is not None:
+                conn.on_close()
+            writer.close()
+    return await asyncio.start_unix_server(connected, path = socketPath)
+
+def run(port, cls, state, dispatcher = None, unixSocket = None):
+    """ Serves cls on port, and on the unix socket at unixSocket if given """
     class Handler(cls, Server):
         def __init__(self, *args, **kwargs):
             super().__init__(*args, **kwargs)
@@ -71,12 +200,16 @@ def run(port, cls, state):
 
     class Ping(tornado.websocket.WebSocketHandler):
         def on_message(self, message):
-            self.write_message("OK")
+            try:
+                id = json.loads(message).get("id", None)
+            except (ValueError, AttributeError):
+                id = None
+            self.write_message("OK" if id is None else json.dumps({"id": id, "result": "OK"}))
 
     application = tornado.web.Application([
         (r'/stop', Stop),
         (r'/ping', Ping),
-        (r'/(.*)', Handler, {"state":state}),
+        (r'/(.*)', Handler, {"state":state, "dispatcher":dispatcher}),
     ])
 
     from tornado.platform.asyncio import AsyncIOMainLoop
@@ -90,6 +223,11 @@ def run(port, cls, state):
 
     http_server.listen(port)
 
+    if unixSocket:
+        class UnixHandler(cls, FramedServer):
+            pass
+        asyncio.get_event_loop().run_until_complete(serveUnix(unixSocket, UnixHandler, {"state":state, "dispatcher":dispatcher}))
+
     asyncio.get_event_loop().run_forever()
 
 if __name__ == "__main__":
@@ -0,0 +1,101 @@
+import json
+import os
+import whoosh.index
+import whoosh.reading
+import whoosh.writing
+import searchers
+import utils
+
+periodFormats = {"year": "%Y", "month": "%Y-%m"}
+
+def periodOf(dt, shardBy):
+    return dt.strftime(periodFormats[shardBy])
+
+class Shard:
+    """ One whoosh index of an Index. Unsharded indexes have a single shard;
+        time-sharded ones have one per period, of which only the newest takes
+        writes. minTime/maxTime are the epoch seconds of the oldest and newest
+        document written to the shard, None when unknown.
+    """
+    def __init__(self, name, dir, schema, minTime = None, maxTime = None, sealed = False):
+        utils.ensureDir(dir)
+        if not whoosh.index.exists_in(dir):
+            whoosh.index.create_in(dir, schema)
+        self.name = name
+        self.dir = dir
+        self.ix = whoosh.index.open_dir(dir)
+        missing = [name for name in schema.names() if name not in self.ix.schema]
+        if missing:
+            # indexes from before a field was added to the schema get it now
+            writer = self.ix.writer()
+            for name in missing:
+                writer.add_field(name, schema[name])
+            writer.commit(mergetype=whoosh.writing.NO_MERGE)
+        self.searchers = searchers.SearcherManager(self.ix)
+        self.minTime = minTime
+        self.maxTime = maxTime
+        self.sealed = sealed
+
+    def overlaps(self, start, end):
+        """ whether the shard may hold documents between start and end (epoch seconds) """
+        if start is not None and self.maxTime is not None and self.maxTime < start:
+            return False
+        if end is not None and self.minTime is not None and self.minTime >= end:
+            return False
+        return True
+
+    def extend(self, timestamp):
+        self.minTime = timestamp if self.minTime is None else min(self.minTime, timestamp)
+        self.maxTime = timestamp if self.maxTime is None else max(self.maxTime, timestamp)
+
+    def seal(self):
+        """ merges the shard down to one segment; it takes no more writes """
+        self.ix.optimize()
+        self.sealed = True
+        self.searchers.refresh()
+
+    def manifest(self):
+        return {"name": self.name, "minTime": self.minTime, "maxTime": self.maxTime, "sealed": self.sealed}
+
+def openShards(dir, schema, shardBy):
+    """ Opens the shards of an index directory, oldest first.
+        Unsharded indexes live in dir itself. Sharded ones keep a
+        subdirectory per period plus shards.json; an unsharded index already
+        in dir is kept as a shard ahead of them, which is sealed (optimized)
+        like any other once a period shard follows it.
+    """
+    if not shardBy:
+        return [Shard("", dir, schema)]
+
+    utils.ensureDir(dir)
+    manifest = {}
+    try:
+        with open(os.path.join(dir, "shards.json"), "r", encoding="utf-8") as f:
+            manifest = {m["name"]:m for m in json.loads(f.read())}
+    except (IOError, ValueError):
+        pass
+
+    def make(name, path):
+        m = manifest.get(name, {})
+        return Shard(name, path, schema, m.get("minTime"), m.get("maxTime"), m.get("sealed", False))
+
+    shards = []
+    if whoosh.index.exists_in(dir):
+        shards.append(make("", dir))
+    names = sorted(n for n in os.listdir(dir) if os.path.isdir(os.path.join(dir, n)) and whoosh.index.exists_in(os.path.join(dir, n)))
+    for name in names:
+        shards.append(make(name, os.path.join(dir, name)))
+    return shards
+
+def saveManifest(dir, shards):
+    path = os.path.join(dir, "shards.json")
+    tmp = path + ".tmp"
+    with open(tmp, "w", encoding="utf-8") as f:
+        f.write(json.dumps([s.manifest() for s in shards]))
+    os.replace(tmp, path)
+
+def combinedReader(readers):
+    """ one reader over the segments of several readers; closing it closes them """
+    if len(readers) == 1:
+        return readers[0]
+    return whoosh.reading.MultiReader([leaf for r in readers for leaf, offset in r.leaf_readers()])
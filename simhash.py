@@ -0,0 +1,61 @@
+import hashlib
+import numpy as np
+
+BITS = 64
+MIN_TERMS = 4 # fewer distinct terms than this get no fingerprint (0)
+
+def termHash(term):
+    return int.from_bytes(hashlib.blake2b(term.encode("utf-8"), digest_size=8).digest(), "little")
+
+def termSigns(term):
+    """ +1/-1 per bit of the term's hash, lowest bit first """
+    bits = (termHash(term) >> np.arange(BITS, dtype=np.uint64)) & np.uint64(1)
+    return (bits.astype(np.int16) * 2 - 1)
+
+def fromSums(sums):
+    """ fingerprints from per-doc sums of termSigns, one row per doc """
+    packed = np.packbits(np.atleast_2d(sums) > 0, axis=-1, bitorder="little")
+    fps = np.ascontiguousarray(packed).view("<u8").reshape(-1)
+    return fps if sums.ndim > 1 else fps[0]
+
+def fingerprint(terms):
+    """ SimHash of a collection of analyzed terms; duplicates count once """
+    terms = set(terms)
+    if len(terms) < MIN_TERMS:
+        return 0
+    sums = np.zeros(BITS, dtype=np.int16)
+    for term in terms:
+        sums += termSigns(term)
+    return int(fromSums(sums))
+
+def hamming(a, b):
+    return bin(a ^ b).count("1")
+
+class NearDupFilter:
+    """ Remembers fingerprints and says whether a new one is within
+        maxDistance bits of one seen before. The fingerprint is cut into
+        maxDistance+1 bands; two fingerprints that close always share a band
+        exactly, so only fingerprints sharing a band are compared.
+    """
+    def __init__(self, maxDistance = 3):
+        self.maxDistance = maxDistance
+        self.bands = maxDistance + 1
+        self.width = BITS // self.bands
+        self.tables = [dict() for i in range(self.bands)]
+
+    def keys(self, fp):
+        mask = (1 << self.width) - 1
+        return [(fp >> (i * self.width)) & mask for i in range(self.bands - 1)] + [fp >> ((self.bands - 1) * self.width)]
+
+    def seen(self, fp):
+        """ True if fp is a near duplicate of an earlier fingerprint, otherwise remembers it """
+        if not fp:
+            return False
+        keys = self.keys(fp)
+        for table, key in zip(self.tables, keys):
+            for other in table.get(key, ()):
+                if hamming(fp, other) <= self.maxDistance:
+                    return True
+        for table, key in zip(self.tables, keys):
+            table.setdefault(key, []).append(fp)
+        return False
@@ -94,7 +94,8 @@ class Soph:
     timeZonepat = re.compile(r"(CET)|(UTC)|(time)|(GMT)|(BST)|(CEST)|(server)", re.IGNORECASE)
     master_id = '178547716014473216'
     aliasPath = "aliases"
-    defaultOpts = {"timing" : False, "timehelp":False, "index":False, "name":"Soph"}
+    # indexTimeout: seconds to wait for the index server, which drops the work after that
+    defaultOpts = {"timing" : False, "timehelp":False, "index":False, "name":"Soph", "indexTimeout":300}
 
     def makeQuery(self, text):
         """ removes ?mark"""
@@ -200,6 +201,8 @@ class Soph:
 			
         self.greeting = self.options.get("greeting", "I'm ready")
         self.optTime = time.time()
+        # the index server listens there too when it has the same "indexSocket" option
+        wsClient.unixSocket = self.options.get("indexSocket", None)
 
         self.loadUsers()
         self.loadAliases()
@@ -265,7 +268,10 @@ class Soph:
                 un[m.name] = m.id
                 for alias in aliasMap[m.id]:
                     un[alias] = m.id
-        results = await wsClient.call(8888, message.server.id, "call", "answer", suffix, un)
+        try:
+            results = await wsClient.call(8888, message.server.id, "call", "answer", suffix, un, timeout = self.options.get("indexTimeout"))
+        except asyncio.TimeoutError:
+            return "That took too long, I gave up..."
         lines = []
         if not results:
             return "I couldn't get an answer for that..."
@@ -437,7 +443,10 @@ class Soph:
             query = suffix
             query = self.makeQuery(query)
             
-            results = await wsClient.call(8888, message.server.id, "call", "termStats", query) 
+            try:
+                results = await wsClient.call(8888, message.server.id, "call", "termStats", query, timeout = self.options.get("indexTimeout"))
+            except asyncio.TimeoutError:
+                return "That took too long, I gave up..."
 
             if len(results) > 10:
                 results = results[:10]
@@ -459,7 +468,10 @@ class Soph:
             query = query.replace(v, k)
         query = self.makeQuery(query)
 
-        results = await wsClient.call(8888, message.server.id, "call", "termStats", query)
+        try:
+            results = await wsClient.call(8888, message.server.id, "call", "termStats", query, timeout = self.options.get("indexTimeout"))
+        except asyncio.TimeoutError:
+            return "That took too long, I gave up..."
 
         if len(results) > 10:
             results = results[:10]
@@ -475,58 +487,64 @@ class Soph:
 
             await self.client.add_reaction(message, "👍🏻")
 
-            done = False
-            async def thinking():
-                try:
-                    nums = list(range(len(Soph.thinkingEmojis)))
-                    random.shuffle(nums)
-                    for i in nums:
-                        eee = Soph.thinkingEmojis[i]
-                        await asyncio.sleep(10)
-                        if not done:
-                            try:
-                                asyncio.ensure_future(self.client.add_reaction(message, eee))
-                            except:
-                                self.log("{0}th emoji was invalid".format(i))
-                except:
-                    pass
-                return True
-
-            asyncio.ensure_future( thinking() )
-
+            # the top terms firm up while they're scored: after a second the
+            # provisional ones are shown and edited as they change, then
+            # swapped for the final answer
+            started = time.time()
+            provisional = None
+            shown = None
+            lastEdit = 0
+            terms = []
             try:
-                terms = await wsClient.call(8888, message.server.id, "call", "userTerms", {uid:name}, corpusThresh = 0, minScore = 0)
-            except:
-                raise
+                async for terms, fraction, final in wsClient.stream(8888, message.server.id, "stream", "userTermsStream", {uid:name},
+                                                                    corpusThresh = 0, minScore = 0, k = 25,
+                                                                    timeout = self.options.get("indexTimeout")):
+                    if final or time.time() - started < 1 or time.time() - lastEdit < 1:
+                        continue
+                    text = self.formatUserTerms(name, terms)
+                    if not text or text == shown:
+                        continue
+                    text += "\nstill thinking... {0}%".format(int(fraction * 100))
+                    if provisional is None:
+                        provisional = await self.client.send_message(message.channel, text)
+                    else:
+                        await self.client.edit_message(provisional, text)
+                    shown = self.formatUserTerms(name, terms)
+                    lastEdit = time.time()
+            except asyncio.TimeoutError:
+                return "That took too long, I gave up..."
             finally:
-                done = True
-   
-            self.log("Got terms")
-            userTerms = collections.defaultdict(list)
-            self.log("Making list")
-            for t in terms:
-                userTerms[t[0]].append(t)
-            ret = ""
-            self.log("Collated {0} terms".format(len(terms)))
-            for uid,t in userTerms.items():
-                t = sorted(t, key=lambda x:-x[2])
+                if provisional is not None:
+                    asyncio.ensure_future(self.client.delete_message(provisional))
 
-                try:
-                    ret += ("Important words for {0}:\n".format(name))
-                except Exception as e:
-                    self.log(e)
-                for tup in t[:25]:
-                    try:
-                        ret += ("\t{0} (score: {1})".format(tup[1], int(tup[2])))
-                        ret += ("\n")
-                    except:
-                        pass
-            if ret:
-                return "```" + ret + "```"
+            self.log("Got {0} terms".format(len(terms)))
+            return self.formatUserTerms(name, terms)
         except Exception as e:
             self.log(e)
         return None
 
+    def formatUserTerms(self, name, terms):
+        userTerms = collections.defaultdict(list)
+        for t in terms:
+            userTerms[t[0]].append(t)
+        ret = ""
+        for uid,t in userTerms.items():
+            t = sorted(t, key=lambda x:-x[2])
+
+            try:
+                ret += ("Important words for {0}:\n".format(name))
+            except Exception as e:
+                self.log(e)
+            for tup in t[:25]:
+                try:
+                    ret += ("\t{0} (score: {1})".format(tup[1], int(tup[2])))
+                    ret += ("\n")
+                except:
+                    pass
+        if ret:
+            return "```" + ret + "```"
+        return None
+
     async def respondImpersonate(self, prefix, suffix, message, timer=NoTimer()):
         reloaded = reloader.reload(markov, "markov.py")
         sid = message.channel.server.id
@@ -0,0 +1,212 @@
+import re
+from collections import defaultdict
+import numpy as np
+import scipy.sparse
+from journalledStore import JournalledStore
+from cancellation import NoCancel
+
+numPat = re.compile(r"^\d+$")
+
+def wantedTerm(term):
+    """ terms that can ever score in 'what does X talk about' """
+    return len(term) >= 3 and not numPat.match(term)
+
+class TermMatrix(JournalledStore):
+    """ Sparse user x term matrix: how many of each user's messages contain
+        each content term, plus the corpus frequency of every term.
+        Rows are IdTable rows. It's built once from the index postings and
+        then updated from the documents of every commit.
+    """
+    def __init__(self, path, analyzer, ids, compactEvery = 200):
+        self.analyzer = analyzer
+        self.ids = ids
+        super().__init__(path, compactEvery)
+
+    def reset(self):
+        self.terms = {}     # term -> column
+        self.termList = []  # column -> term
+        self.base = scipy.sparse.csr_matrix((0, 0), dtype=np.int32)
+        self.delta = defaultdict(int) # (row, column) -> count, not folded into base yet
+        self.freq = np.zeros(0, dtype=np.int64)
+
+    def row(self, uid):
+        return self.ids.intern(uid)
+
+    def column(self, term):
+        c = self.terms.get(term)
+        if c is None:
+            c = self.terms[term] = len(self.termList)
+            self.termList.append(term)
+        return c
+
+    def apply(self, entry):
+        """ entry["occs"]: [uid, term, docs], entry["freqs"]: term -> occurrences """
+        with self.lock:
+            for uid, term, n in entry["occs"]:
+                self.delta[(self.row(uid), self.column(term))] += n
+            if len(self.termList) > len(self.freq):
+                self.freq = np.concatenate([self.freq, np.zeros(len(self.termList) - len(self.freq), dtype=np.int64)])
+            for term, n in entry["freqs"].items():
+                self.freq[self.terms[term]] += n
+
+    def snapshot(self):
+        """ returns (matrix, freq, termList) with pending updates folded in """
+        with self.lock:
+            shape = (len(self.ids), len(self.termList))
+            if self.delta or self.base.shape != shape:
+                base = self.base.tocoo()
+                keys = list(self.delta.keys())
+                rows = np.concatenate([base.row, np.array([k[0] for k in keys], dtype=np.int32)])
+                cols = np.concatenate([base.col, np.array([k[1] for k in keys], dtype=np.int32)])
+                data = np.concatenate([base.data, np.array(list(self.delta.values()), dtype=np.int32)])
+                self.base = scipy.sparse.csr_matrix((data, (rows, cols)), shape=shape, dtype=np.int32)
+                self.delta = defaultdict(int)
+            return self.base, self.freq, list(self.termList)
+
+    def arrays(self):
+        matrix, freq, termList = self.snapshot()
+        return dict(rows=np.array(matrix.shape[0]), terms=np.array(termList, dtype=str),
+                    data=matrix.data, indices=matrix.indices, indptr=matrix.indptr, freq=freq)
+
+    def restore(self, z):
+        rows = int(z["rows"])
+        self.termList = [str(t) for t in z["terms"]]
+        self.terms = {t:i for i,t in enumerate(self.termList)}
+        self.base = scipy.sparse.csr_matrix((z["data"], z["indices"], z["indptr"]),
+                                            shape=(rows, len(self.termList)))
+        self.delta = defaultdict(int)
+        self.freq = z["freq"]
+
+    def build(self, reader):
+        docUser = np.zeros(reader.doc_count_all(), dtype=np.int32)
+        for uid in reader.field_terms("user"):
+            ids = np.fromiter(reader.postings("user", uid).all_ids(), dtype=np.int64)
+            docUser[ids] = self.row(uid)
+
+        rows, cols, data = [], [], []
+        freqs = []
+        for term in reader.field_terms("content"):
+            if not wantedTerm(term):
+                continue
+            ids = np.fromiter(reader.postings("content", term).all_ids(), dtype=np.int64)
+            users, n = np.unique(docUser[ids], return_counts=True)
+            c = self.column(term)
+            rows.append(users)
+            cols.append(np.full(len(users), c, dtype=np.int32))
+            data.append(n)
+            freqs.append(reader.frequency("content", term))
+
+        shape = (len(self.ids), len(self.termList))
+        if rows:
+            self.base = scipy.sparse.csr_matrix((np.concatenate(data), (np.concatenate(rows), np.concatenate(cols))),
+                                                shape=shape, dtype=np.int32)
+        else:
+            self.base = scipy.sparse.csr_matrix(shape, dtype=np.int32)
+        self.freq = np.array(freqs, dtype=np.int64)
+
+    def update(self, docs):
+        occs = defaultdict(int)
+        freqs = defaultdict(int)
+        for doc in docs:
+            tokens = [t.text for t in self.analyzer(doc["content"])]
+            tokens = [t for t in tokens if wantedTerm(t)]
+            for t in tokens:
+                freqs[t] += 1
+            for t in set(tokens):
+                occs[(doc["user"], t)] += 1
+        self.record({"docs": len(docs),
+                     "occs": [[u, t, n] for (u, t), n in occs.items()],
+                     "freqs": freqs})
+
+    def score(self, uids, countsOf, corpusThresh, minScore, cancel = NoCancel(), chunkRows = 4096):
+        """ Scores every candidate term for the given users (all users if None),
+            vectorized over chunkRows users at a time with a cancel checkpoint
+            between chunks. countsOf maps an array of rows to their message
+            counts. Returns [(uid, term, score)]
+        """
+        matrix, freq, termList = self.snapshot()
+        numDocs = self.docCount
+        if uids is None:
+            allRows = np.arange(matrix.shape[0])
+        else:
+            allRows = np.array([r for r in map(self.ids.lookup, uids) if r is not None and r < matrix.shape[0]], dtype=np.int64)
+        if not len(allRows) or not numDocs:
+            return []
+
+        candidates = np.flatnonzero((freq > 50) & (freq < numDocs/100))
+        ret = []
+        for first in range(0, len(allRows), chunkRows):
+            cancel.check()
+            rows = allRows[first:first + chunkRows]
+            sub = matrix[rows][:, candidates].tocoo()
+            occs = sub.data.astype(np.float64)
+            termFreq = freq[candidates][sub.col]
+            totals = countsOf(rows).astype(np.float64)[sub.row]
+
+            keep = (occs > corpusThresh * termFreq) & (totals > 0)
+            with np.errstate(divide="ignore", invalid="ignore"):
+                scores = (occs / totals) / (termFreq / numDocs)
+                keep &= scores > 0
+                scores = np.where(keep, np.log(np.where(keep, scores, 1)) * 10, 0)
+            keep &= scores > minScore
+
+            for i in np.flatnonzero(keep):
+                ret.append((self.ids[rows[sub.row[i]]], termList[candidates[sub.col[i]]], float(scores[i])))
+        return ret
+
+    def topTerms(self, uids, countsOf, corpusThresh, minScore, k = 25, chunkTerms = 2048, cancel = NoCancel()):
+        """ Generator of snapshots of the k best terms per user, scored like
+            score(), as ([(uid, term, score)], fraction of candidates done,
+            final). Candidates go rarest first and a term of corpus
+            frequency f can't score above log(numDocs / max(f, messages)) * 10,
+            so once every user's k-th best beats that for the next candidate
+            the rest can't change the answer and the last snapshot is final.
+        """
+        matrix, freq, termList = self.snapshot()
+        numDocs = self.docCount
+        if uids is None:
+            rows = np.arange(matrix.shape[0])
+        else:
+            rows = np.array([r for r in map(self.ids.lookup, uids) if r is not None and r < matrix.shape[0]], dtype=np.int64)
+        candidates = np.flatnonzero((freq > 50) & (freq < numDocs/100)) if numDocs else np.zeros(0, dtype=np.int64)
+        if not len(rows) or not len(candidates):
+            yield [], 1.0, True
+            return
+        candidates = candidates[np.argsort(freq[candidates], kind="stable")]
+        totals = countsOf(rows).astype(np.float64)
+        userMatrix = matrix[rows]
+        best = [[] for r in rows] # per user [(score, column)], best first, at most k
+
+        for first in range(0, len(candidates), chunkTerms):
+            cancel.check()
+            columns = candidates[first:first + chunkTerms]
+            sub = userMatrix[:, columns].tocoo()
+            occs = sub.data.astype(np.float64)
+            termFreq = freq[columns][sub.col]
+            userTotals = totals[sub.row]
+
+            keep = (occs > corpusThresh * termFreq) & (userTotals > 0)
+            with np.errstate(divide="ignore", invalid="ignore"):
+                scores = (occs / userTotals) / (termFreq / numDocs)
+                keep &= scores > 0
+                scores = np.where(keep, np.log(np.where(keep, scores, 1)) * 10, 0)
+            keep &= scores > minScore
+
+            touched = set()
+            for i in np.flatnonzero(keep):
+                best[sub.row[i]].append((float(scores[i]), int(columns[sub.col[i]])))
+                touched.add(sub.row[i])
+            for r in touched:
+                best[r] = sorted(best[r], key=lambda x: -x[0])[:k]
+
+            done = first + len(columns)
+            final = done == len(candidates)
+            if not final:
+                with np.errstate(divide="ignore"):
+                    bound = np.log(numDocs / np.maximum(freq[candidates[done]], totals)) * 10
+                final = all(totals[r] <= 0 or bound[r] <= minScore or (len(best[r]) >= k and best[r][k - 1][0] >= bound[r])
+                            for r in range(len(rows)))
+            yield ([(self.ids[rows[r]], termList[c], s) for r in range(len(rows)) for s, c in best[r]],
+                   done / len(candidates), final)
+            if final:
+                return
@@ -1,10 +1,14 @@
 import json
 import re
 import index
+import merges
+import cursors
 import subject
 from sophLogger import SophLogger
 from timer import Timer,NoTimer
+from cancellation import NoCancel
 import question
+import nlp
 
 
 def stripMentions(text, userNames):
@@ -24,12 +28,26 @@ class TextEngine:
         self.dir = opts.get("dir", "index")
         self.start = opts.get("startIndexing", False)
         self.maxResults = int(opts.get("maxResults", 150))
-        self.index = index.Index(self.dir, start = self.start)
+        self.index = index.Index(self.dir, start = self.start,
+                                 commitDocs = int(opts.get("commitDocs", 20000)),
+                                 commitLatency = float(opts.get("commitLatency", 1.0)),
+                                 cacheEntries = int(opts.get("cacheEntries", 1024)),
+                                 cacheBytes = int(opts.get("cacheBytes", 32*1024*1024)),
+                                 shardBy = opts.get("shardBy", None),
+                                 searchThreads = int(opts.get("searchThreads", 4)),
+                                 mergePolicy = merges.TieredPolicy(int(opts.get("segmentsPerTier", 10)),
+                                                                   int(opts.get("maxMergeAtOnce", 10))),
+                                 offPeakHours = merges.parseHours(opts.get("offPeakHours", None)),
+                                 mergeQuiet = float(opts.get("mergeQuiet", 30)),
+                                 nearDupDistance = int(opts.get("nearDupDistance", 3)),
+                                 collapseNearDups = bool(opts.get("collapseNearDups", False)))
+        self.cursors = cursors.CursorTable(float(opts.get("cursorTimeout", 60)), int(opts.get("maxCursors", 64)))
         self.qp = question.DumbQuestionParser()     
     
-    def answer(self, qtext, users = {}, timer=NoTimer()):
+    def answer(self, qtext, users = {}, timer=NoTimer(), cancel=NoCancel()):
         """ Find lines that answer the question 'who verbs?'
             users should be a map of userName -> userIds
+            cancel is checked before every candidate goes through the NLP filter
         """
         userIds = {v:k for k,v in users.items()}
 
@@ -76,9 +94,6 @@ class TextEngine:
 
         searchtext = " AND ".join(predicates)
 
-        with timer.sub_timer("combined-query") as t:
-            res = self.index.query(searchtext, self.maxResults, restrictUser, expand=True, userNames=thisUserNames, dedupe=True, timer=t)
-            
         want_bool = False
         any_subj = False
         pred = None
@@ -104,10 +119,15 @@ class TextEngine:
             else:
                 want_bool = True
 
-        with timer.sub_timer("subject-filter") as t:
-            for r in res:
+        with timer.sub_timer("combined-query") as t:
+            cursor = self.index.openCursor(searchtext, restrictUser, expand=True, userNames=thisUserNames, dedupe=True)
+
+        # pages are only read until enough results pass the filter
+        with timer.sub_timer("subject-filter") as t, cursor:
+            for r in cursor.rows(pageSize = 25, max = self.maxResults):
                 if len(filteredResults) >= 10:
                     break
+                cancel.check()
                 try:
                     if not doFilter:
                         filteredResults.append(r)
@@ -134,9 +154,66 @@ class TextEngine:
             results = self.index.queryStats(query, expand=True, timer= t)
             return [r + (self.index.getCounts(r[1]) ,) for r in results]
 
-    async def userTerms(self, usernames, corpusThresh = 0.0, minScore = 450):
+    def openCursor(self, query, user = None, expand = True, userNames = [], pageSize = 50, start = None, end = None):
+        """ Opens a cursor over the hits of query and returns its first page
+            as {"cursor", "rows", "done"}; see fetchCursor
+        """
+        cursor = self.index.openCursor(query, user, expand = expand, userNames = userNames, start = start, end = end)
+        return self.cursors.fetch(self.cursors.add(cursor), pageSize)
+
+    def fetchCursor(self, cursorId, pageSize = 50):
+        """ the next page of a cursor, which is closed once "done" is true """
+        return self.cursors.fetch(cursorId, pageSize)
+
+    def closeCursor(self, cursorId):
+        return self.cursors.close(cursorId)
+
+    def prewarm(self, canaries = ()):
+        """ waits for the spaCy model and warms the index with the canary queries """
+        nlp.get()("warm up")
+        self.index.warm(canaries)
+
+    def memoryUsage(self):
+        return self.index.memoryUsage()
+
+    def openCursorCount(self):
+        return self.cursors.stats()["open"]
+
+    def close(self):
+        """ closes the open cursors and the index; the engine can't be used afterwards """
+        self.cursors.closeAll()
+        self.index.close()
+
+    def indexStats(self):
+        return {"cache": self.index.cacheStats(),
+                "cursors": self.cursors.stats(),
+                "content": self.index.content.stats(),
+                "searchers": self.index.searcherStats(),
+                "merges": self.index.mergeStats(),
+                "memory": self.index.memoryUsage()}
+
+    def getCounts(self, uid):
+        """ how many messages uid has posted """
+        return self.index.getCounts(uid)
+
+    def activity(self, userIds = None, start = None, end = None):
+        """ weekday x hour activity heatmap for a set of user ids """
+        return self.index.getActivity(userIds, start, end)
+
+    def topMentioners(self, uid, k = 10, start = None, end = None):
+        return self.index.topMentioners(uid, k, start, end)
+
+    def reciprocalMentions(self, uid, start = None, end = None):
+        return self.index.reciprocalMentions(uid, start, end)
+
+    async def userTerms(self, usernames, corpusThresh = 0.0, minScore = 450, cancel = NoCancel()):
         with Timer("userTerms") as t:
-            return await self.index.terms_async(usernames, corpusThresh, corpusNorm = True, minScore = minScore, timer = t)
+            return await self.index.terms_async(usernames, corpusThresh, corpusNorm = True, minScore = minScore, timer = t, cancel = cancel)
+
+    async def userTermsStream(self, usernames, corpusThresh = 0.0, minScore = 450, k = 25, cancel = NoCancel()):
+        """ userTerms() limited to the k best per user, as snapshots that firm up while it runs """
+        async for step in self.index.terms_stream(usernames, corpusThresh, minScore, k, cancel = cancel):
+            yield step
 
     async def relationships(self, idsMap:dict, uid):
         """ idsMap: dict id -> list [ userNames ]"""
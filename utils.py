@@ -1,5 +1,7 @@
 from collections import OrderedDict
 import os
+import sys
+import threading
 
 def ensureDirs(path):
     components = os.path.normpath(path).split(os.sep)
@@ -43,4 +45,62 @@ class MRU:
         if k in self.map:
             self.map.move_to_end(k)
             return self.map[k]
-        return None
\ No newline at end of file
+        return None
+
+def sizeOf(value):
+    """ rough byte size of nested lists/tuples/dicts of strings and numbers """
+    if isinstance(value, (list, tuple, set)):
+        return sys.getsizeof(value) + sum(sizeOf(v) for v in value)
+    if isinstance(value, dict):
+        return sys.getsizeof(value) + sum(sizeOf(k) + sizeOf(v) for k, v in value.items())
+    return sys.getsizeof(value)
+
+class LRUCache:
+    """ Thread safe LRU bounded by entry count and approximate bytes, with hit counters """
+    def __init__(self, maxEntries = 1024, maxBytes = 32*1024*1024):
+        self.map = OrderedDict()
+        self.maxEntries = maxEntries
+        self.maxBytes = maxBytes
+        self.bytes = 0
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, k):
+        with self.lock:
+            if k in self.map:
+                self.map.move_to_end(k)
+                self.hits += 1
+                return self.map[k][0]
+            self.misses += 1
+            return None
+
+    def insert(self, k, v):
+        size = sizeOf(v)
+        if size > self.maxBytes:
+            return
+        with self.lock:
+            if k in self.map:
+                self.bytes -= self.map.pop(k)[1]
+            self.map[k] = (v, size)
+            self.bytes += size
+            while len(self.map) > self.maxEntries or self.bytes > self.maxBytes:
+                old, (oldV, oldSize) = self.map.popitem(last=False)
+                self.bytes -= oldSize
+                self.evictions += 1
+
+    def clear(self):
+        with self.lock:
+            self.map.clear()
+            self.bytes = 0
+
+    def stats(self):
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {"entries": len(self.map),
+                    "bytes": self.bytes,
+                    "hits": self.hits,
+                    "misses": self.misses,
+                    "evictions": self.evictions,
+                    "hitRate": self.hits / lookups if lookups else 0.0}
@@ -0,0 +1,68 @@
+import asyncio
+import json
+import struct
+import zlib
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+# websocket subprotocols in order of preference. Frames of a negotiated
+# connection are binary: one flag byte (PLAIN or ZLIB) and the encoded
+# message. A connection that negotiated nothing speaks json text frames.
+MSGPACK = "soph.msgpack"
+JSON = "soph.json"
+PLAIN = b"\x00"
+ZLIB = b"\x01"
+COMPRESS_ABOVE = 16 * 1024 # bytes of encoded message
+# on a unix socket every frame is prefixed by its length
+LENGTH = struct.Struct(">I")
+
+def protocols():
+    """ the subprotocols this side can speak, best first """
+    return [MSGPACK, JSON] if msgpack else [JSON]
+
+def select(offered):
+    """ the best of the offered subprotocols this side speaks, or None """
+    for protocol in protocols():
+        if protocol in offered:
+            return protocol
+    return None
+
+def encode(protocol, obj, compressAbove = COMPRESS_ABOVE):
+    """ a frame for obj: bytes on a negotiated connection, json text otherwise """
+    if protocol is None:
+        return obj if type(obj) == str else json.dumps(obj)
+    if protocol == MSGPACK:
+        payload = msgpack.packb(obj, use_bin_type = True)
+    else:
+        payload = json.dumps(obj).encode("utf-8")
+    if compressAbove is not None and len(payload) > compressAbove:
+        return ZLIB + zlib.compress(payload, 1)
+    return PLAIN + payload
+
+def decode(protocol, frame):
+    """ the message in frame; a text frame that isn't json comes back as the string """
+    if isinstance(frame, str) or protocol is None:
+        try:
+            return json.loads(frame)
+        except ValueError:
+            return frame
+    payload = zlib.decompress(frame[1:]) if frame[:1] == ZLIB else frame[1:]
+    if protocol == MSGPACK:
+        return msgpack.unpackb(payload, raw = False, strict_map_key = False)
+    return json.loads(payload)
+
+def framed(frame):
+    """ frame prefixed by its length, for a unix socket """
+    if isinstance(frame, str):
+        frame = frame.encode("utf-8")
+    return LENGTH.pack(len(frame)) + frame
+
+async def readFramed(reader):
+    """ the next length prefixed frame from an asyncio StreamReader, None once it's closed """
+    try:
+        size, = LENGTH.unpack(await reader.readexactly(LENGTH.size))
+        return await reader.readexactly(size)
+    except (asyncio.IncompleteReadError, ConnectionError):
+        return None
@@ -1,19 +1,265 @@
 import asyncio
-import websockets
+import itertools
 import json
+import websockets
+import wire
 
-async def call(port = 8888, path = "196373421834240000", method = "", *args, **kwargs):
-    url = 'ws://localhost:{0}/{1}'.format(port, path)
-    async with websockets.connect(url) as websocket:
-        payload = json.dumps( {"method":method, "args":args, "kwargs":kwargs })
-        await websocket.send(payload)
-        greeting = await websocket.recv()
+# the index server's unix socket (its "indexSocket" option); when set,
+# connections go over it and only fall back to the websocket without it
+unixSocket = None
+
+class RemoteError(Exception):
+    """ a call that raised on the server """
+    pass
+
+class FramedSocket:
+    """ The client end of server.FramedServer, with as much of a websocket's
+        interface as Connection uses
+    """
+    def __init__(self, reader, writer, subprotocol):
+        self.reader = reader
+        self.writer = writer
+        self.subprotocol = subprotocol
+
+    @staticmethod
+    async def connect(socketPath, path):
+        reader, writer = await asyncio.open_unix_connection(socketPath)
+        writer.write(wire.framed(json.dumps({"path": path, "protocols": wire.protocols()})))
+        hello = await wire.readFramed(reader)
+        if hello is None:
+            writer.close()
+            raise ConnectionRefusedError("{0} closed during the handshake".format(socketPath))
+        return FramedSocket(reader, writer, json.loads(hello)["protocol"])
+
+    async def send(self, frame):
+        if self.writer.is_closing():
+            raise websockets.ConnectionClosed(None, None)
+        self.writer.write(wire.framed(frame))
+        try:
+            await self.writer.drain()
+        except ConnectionError:
+            raise websockets.ConnectionClosed(None, None)
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        frame = await wire.readFramed(self.reader)
+        if frame is None:
+            raise StopAsyncIteration
+        return frame
+
+    async def close(self):
+        self.writer.close()
+
+class Connection:
+    """ One persistent websocket to a path that any number of calls share.
+        Every request carries an id that the server echoes, so answers are
+        matched to their callers in whatever order they come back. Frames
+        are msgpack where both sides have it, json otherwise. An answer
+        without an id (a server that doesn't echo them) goes to the oldest
+        call waiting. A dropped connection is reopened by the next call.
+        Progress frames of a stream() go to its queue ahead of the answer.
+        With a unixSocket it connects through that to path while it can.
+    """
+    def __init__(self, url, compressAbove = wire.COMPRESS_ABOVE, unixSocket = None, path = None):
+        self.url = url
+        self.compressAbove = compressAbove
+        self.unixSocket = unixSocket
+        self.path = path
+        self.websocket = None
+        self.pending = {} # id -> (websocket, future of the answer, progress queue or None), in send order
+        self.ids = itertools.count()
+        self.lock = asyncio.Lock()
+
+    async def connect(self):
+        async with self.lock:
+            if self.websocket is None:
+                websocket = None
+                if self.unixSocket:
+                    try:
+                        websocket = await FramedSocket.connect(self.unixSocket, self.path)
+                    except OSError:
+                        pass # no server on the socket (yet), try the websocket
+                if websocket is None:
+                    websocket = await websockets.connect(self.url, max_size = None, subprotocols = wire.protocols())
+                self.websocket = websocket
+                asyncio.ensure_future(self.readLoop(websocket))
+            return self.websocket
+
+    async def readLoop(self, websocket):
         try:
-            return json.loads(greeting)
-        except:
-            return greeting
+            async for message in websocket:
+                self.dispatch(websocket, message)
+        except websockets.ConnectionClosed:
+            pass
+        finally:
+            if self.websocket is websocket:
+                self.websocket = None
+            # whatever was sent over this connection won't be answered any more
+            for id, (sentOn, future, progress) in list(self.pending.items()):
+                if sentOn is websocket and not future.done():
+                    future.set_exception(websockets.ConnectionClosed(None, None))
+
+    def dispatch(self, websocket, message):
+        j = wire.decode(websocket.subprotocol, message)
+        if isinstance(j, dict) and "id" in j:
+            sentOn, future, progress = self.pending.get(j["id"], (None, None, None))
+            if future is None or future.done():
+                return # a call that was given up on
+            if "progress" in j:
+                if progress is not None:
+                    progress.put_nowait(j["progress"])
+            elif "error" in j:
+                future.set_exception(RemoteError(j["error"]))
+            else:
+                future.set_result(j.get("result"))
+            return
+        for id, (sentOn, future, progress) in self.pending.items():
+            if sentOn is websocket and not future.done():
+                future.set_result(j)
+                return
+
+    async def call(self, method, *args, timeout = None, **kwargs):
+        """ Sends one request and waits for its answer; a connection that
+            drops meanwhile is reopened and the request sent once more.
+            With a timeout the server is told how long this caller waits and
+            stops the work after that, or as soon as the caller gives up.
+        """
+        deadline = None if timeout is None else asyncio.get_event_loop().time() + timeout
+        for attempt in range(2):
+            websocket = await self.connect()
+            id = next(self.ids)
+            future = asyncio.get_event_loop().create_future()
+            self.pending[id] = (websocket, future, None)
+            request = {"id": id, "method": method, "args": args, "kwargs": kwargs}
+            if deadline is not None:
+                request["timeout"] = max(deadline - asyncio.get_event_loop().time(), 0)
+            try:
+                await websocket.send(wire.encode(websocket.subprotocol, request, self.compressAbove))
+                if deadline is None:
+                    return await future
+                return await asyncio.wait_for(future, request["timeout"])
+            except (asyncio.TimeoutError, asyncio.CancelledError):
+                await self.cancel(websocket, id)
+                raise
+            except websockets.ConnectionClosed:
+                if self.websocket is websocket:
+                    self.websocket = None
+                if attempt:
+                    raise
+            finally:
+                del self.pending[id]
+
+    async def stream(self, method, *args, timeout = None, **kwargs):
+        """ Sends one request and yields each progress value the server
+            sends for it, then its answer. Unlike call() nothing is resent
+            if the connection drops. Stopping early, or the timeout passing,
+            tells the server to stop the work.
+        """
+        loop = asyncio.get_event_loop()
+        deadline = None if timeout is None else loop.time() + timeout
+        websocket = await self.connect()
+        id = next(self.ids)
+        future = loop.create_future()
+        progress = asyncio.Queue()
+        self.pending[id] = (websocket, future, progress)
+        request = {"id": id, "method": method, "args": args, "kwargs": kwargs}
+        if deadline is not None:
+            request["timeout"] = timeout
+        finished = False
+        try:
+            await websocket.send(wire.encode(websocket.subprotocol, request, self.compressAbove))
+            while True:
+                getter = asyncio.ensure_future(progress.get())
+                try:
+                    remaining = None if deadline is None else max(deadline - loop.time(), 0)
+                    done, waiting = await asyncio.wait([getter, future], timeout = remaining, return_when = asyncio.FIRST_COMPLETED)
+                finally:
+                    getter.cancel()
+                if getter in done:
+                    yield getter.result()
+                elif future.done():
+                    finished = True
+                    yield future.result()
+                    return
+                else:
+                    raise asyncio.TimeoutError()
+        finally:
+            del self.pending[id]
+            if not finished:
+                await self.cancel(websocket, id)
+
+    async def cancel(self, websocket, id):
+        """ tells the server to stop working on call id, if the connection is still there """
+        try:
+            request = {"id": next(self.ids), "method": "cancel", "args": [id]}
+            await websocket.send(wire.encode(websocket.subprotocol, request, self.compressAbove))
+        except websockets.ConnectionClosed:
+            pass
+
+    async def close(self):
+        if self.websocket is not None:
+            await self.websocket.close()
+            self.websocket = None
+
+connections = {} # (event loop, url, unixSocket) -> Connection
+
+def connection(port = 8888, path = "196373421834240000"):
+    """ the shared Connection to path """
+    url = 'ws://localhost:{0}/{1}'.format(port, path)
+    key = (asyncio.get_event_loop(), url, unixSocket)
+    conn = connections.get(key)
+    if conn is None:
+        conn = connections[key] = Connection(url, unixSocket = unixSocket, path = path)
+    return conn
+
+async def closeAll():
+    for key, conn in list(connections.items()):
+        await conn.close()
+        del connections[key]
+
+async def call(port = 8888, path = "196373421834240000", method = "", *args, timeout = None, **kwargs):
+    """ method(*args, **kwargs) on the server; timeout (seconds) makes the server drop the work once nobody waits for it """
+    return await connection(port, path).call(method, *args, timeout = timeout, **kwargs)
+
+async def batch(port = 8888, path = "196373421834240000", calls = [], timeout = None):
+    """ Sends (sid, method, args, kwargs) engine calls in one frame, sid None
+        meaning path; the server runs them concurrently. Returns their
+        results in order, with a RemoteError in place of any that failed.
+    """
+    calls = [[call[0], call[1], list(call[2]) if len(call) > 2 else [], call[3] if len(call) > 3 else {}] for call in calls]
+    results = await connection(port, path).call("batch", calls, timeout = timeout)
+    return [RemoteError(r["error"]) if "error" in r else r["result"] for r in results]
+
+async def stream(port = 8888, path = "196373421834240000", method = "", *args, timeout = None, **kwargs):
+    """ Yields the progress of method(*args, **kwargs) on the server, then its result """
+    async for value in connection(port, path).stream(method, *args, timeout = timeout, **kwargs):
+        yield value
+
+async def cursor(port = 8888, path = "196373421834240000", query = "", pageSize = 50, **kwargs):
+    """ Yields the (user, content) hits of query page by page. Stopping
+        early closes the cursor on the server. The server drops the cursor
+        if the connection does, so a reconnect part way through fails the
+        next page.
+    """
+    conn = connection(port, path)
+    async def send(method, *args, **kw):
+        return await conn.call("call", method, *args, **kw)
+
+    page = await send("openCursor", query, pageSize = pageSize, **kwargs)
+    try:
+        while True:
+            for row in page["rows"]:
+                yield tuple(row)
+            if page["done"]:
+                break
+            page = await send("fetchCursor", page["cursor"], pageSize)
+    finally:
+        if not page["done"]:
+            await send("closeCursor", page["cursor"])
 
 if __name__ == "__main__":
     tasks = [call(8888, "196373421834240000", "call", "queryStats", "Vindictus") for i in range(0,1)]
-    
-    asyncio.get_event_loop().run_until_complete( asyncio.gather(*tasks))
\ No newline at end of file
+
+    asyncio.get_event_loop().run_until_complete( asyncio.gather(*tasks))